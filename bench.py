@@ -0,0 +1,587 @@
+"""Benchmarks for Dark Bot hot paths.
+
+Usage:
+    python bench.py classifier [--iterations N] [--extra-phrases N]
+    python bench.py load {private,group,photo,replay} [options]
+
+The load test runs DarkBot's real handlers against an in-process stub of
+the Telegram Bot API and an OpenAI-compatible stub model server. Bot
+settings come from the usual environment variables (e.g. LLM_RATE,
+STREAM_REPLIES); run ``python bench.py load --help`` for the options.
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import string
+import time
+import timeit
+
+from aiohttp import web
+from PIL import Image
+
+import main
+from main import DEFAULT_KEYWORDS, KeywordClassifier
+
+# =========================
+# Keyword Classifier
+# =========================
+
+SAMPLE_MESSAGES = [
+    "hi",
+    "hey dark wassup",
+    "can you explain in detail how does a transformer work",
+    "this book is really good, what do you think about the ending?",
+    "who created you?",
+    "lol that's so true",
+    "I was wondering if you could help me plan a trip to the mountains next week",
+    "who programmed you and what language did they use",
+    "ok thanks",
+    "tell me more about black holes and why does time slow down near them",
+    # Long messages: the legacy scan re-reads these once per phrase
+    "so basically what happened today was that I went to the store and the "
+    "cashier was super rude to me and then I dropped my phone on the way back "
+    "home and the screen cracked and now I need a new one but money is tight "
+    "this month because rent went up again and my landlord won't fix the heater "
+    "either, honestly it has been a rough week and I just needed to vent",
+    "ok so here's my essay intro, can you check the grammar: " + "the " * 80,
+]
+
+
+def legacy_classify(keywords: dict[str, list[str]], text: str) -> set[str]:
+    """The previous approach: one substring scan per phrase per category."""
+    lower = text.lower()
+    return {
+        category
+        for category, phrases in keywords.items()
+        if any(phrase in lower for phrase in phrases)
+    }
+
+
+def random_phrase(rng: random.Random) -> str:
+    return " ".join(
+        "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8)))
+        for _ in range(rng.randint(1, 3))
+    )
+
+
+def bench_classifier(iterations: int, extra_phrases: int) -> None:
+    rng = random.Random(42)
+    keywords = {k: list(v) for k, v in DEFAULT_KEYWORDS.items()}
+    if extra_phrases:
+        # Simulates a larger configured keyword list (KEYWORDS_FILE)
+        keywords["custom"] = [random_phrase(rng) for _ in range(extra_phrases)]
+
+    classifier = KeywordClassifier(keywords)
+    messages = [rng.choice(SAMPLE_MESSAGES) for _ in range(1000)]
+
+    def run(func) -> float:
+        best = min(
+            timeit.repeat(lambda: [func(m) for m in messages], number=1, repeat=iterations)
+        )
+        return best / len(messages) * 1e6
+
+    legacy_us = run(lambda m: legacy_classify(keywords, m))
+    compiled_us = run(classifier.classify)
+
+    phrase_count = sum(len(v) for v in keywords.values())
+    print(f"phrases               : {phrase_count}")
+    print(f"legacy substring scan : {legacy_us:7.2f} µs/message")
+    print(f"compiled classifier   : {compiled_us:7.2f} µs/message")
+    print(f"speedup               : {legacy_us / compiled_us:7.2f}x")
+
+    for message in SAMPLE_MESSAGES:
+        legacy = legacy_classify(keywords, message)
+        compiled = classifier.classify(message)
+        if legacy != compiled:
+            print(
+                f"  differs: {message[:60]!r}: legacy={sorted(legacy)} "
+                f"compiled={sorted(compiled)}"
+            )
+
+
+# =========================
+# Load Test: Stub Servers
+# =========================
+
+BOT_TOKEN = "123456:bench"
+BOT_USERNAME = "darkbench"
+BOT_ID = 123456
+
+# Every synthetic message carries a tag; the stub model echoes the tags it
+# sees in the prompt, so a reply can be matched to the messages it answers
+TAG_RE = re.compile(r"msg#(\d+)")
+
+
+async def start_site(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+class FakeTelegram:
+    """Enough of the Bot API for DarkBot: getMe, sends, edits and file downloads.
+
+    Replies are matched to pending messages by tag; streamed previews (which
+    end with the cursor) don't count as a reply.
+    """
+
+    def __init__(self, latency: float, photo: bytes) -> None:
+        self.latency = latency
+        self.photo = photo
+        self.message_ids = itertools.count(1_000_000)
+        self.sent: dict[int, float] = {}
+        self.latencies: list[float] = []
+        self.last_reply = 0.0
+        self.requests = 0
+        self.error_replies = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file)
+        return app
+
+    def track(self, tag: int) -> None:
+        self.sent[tag] = time.perf_counter()
+
+    @property
+    def pending(self) -> int:
+        return len(self.sent)
+
+    async def api(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        method = request.match_info["method"]
+        params = dict(await request.post())
+
+        if method == "getMe":
+            return self.ok(
+                {"id": BOT_ID, "is_bot": True, "first_name": "Dark", "username": BOT_USERNAME}
+            )
+        if method == "getFile":
+            file_id = params["file_id"]
+            return self.ok(
+                {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "file_size": len(self.photo),
+                    "file_path": f"photos/{file_id}.jpg",
+                }
+            )
+        if method in ("sendMessage", "editMessageText"):
+            self.record_reply(params.get("text", ""))
+            chat_id = int(params.get("chat_id") or 0)
+            return self.ok(
+                {
+                    "message_id": int(params.get("message_id") or next(self.message_ids)),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "Dark"},
+                    "text": params.get("text", ""),
+                }
+            )
+        return self.ok(True)
+
+    async def file(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+    def record_reply(self, text: str) -> None:
+        if text.endswith(main.STREAM_CURSOR):
+            return
+        if text == main.LLM_ERROR_REPLY:
+            self.error_replies += 1
+        now = time.perf_counter()
+        for tag in TAG_RE.findall(text):
+            sent = self.sent.pop(int(tag), None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+                self.last_reply = now
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeModel:
+    """OpenAI-compatible /chat/completions with latency and error injection."""
+
+    def __init__(
+        self,
+        latency: float,
+        jitter: float,
+        error_rate: float,
+        throttle_rate: float,
+        reply_words: int,
+        seed: int,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.reply_words = reply_words
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.completions)
+        return app
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        self.calls += 1
+        body = await request.json()
+        delay = max(0.0, self.rng.gauss(self.latency, self.jitter))
+
+        roll = self.rng.random()
+        if roll < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(delay / 2)
+            return web.json_response({"error": {"message": "injected failure"}}, status=500)
+        if roll < self.error_rate + self.throttle_rate:
+            self.throttled += 1
+            return web.json_response(
+                {"error": {"message": "injected rate limit"}},
+                status=429,
+                headers={"retry-after": "1"},
+            )
+
+        tags = sorted(set(TAG_RE.findall(json.dumps(body["messages"]))), key=int)
+        words = ["lol", "fr", "no", "cap", "bet", "that's", "lowkey", "valid"]
+        text = " ".join(self.rng.choice(words) for _ in range(self.reply_words))
+        text += " " + " ".join(f"msg#{tag}" for tag in tags)
+
+        if body.get("stream"):
+            return await self.stream(request, body["model"], text, delay)
+
+        await asyncio.sleep(delay)
+        return web.json_response(
+            {
+                "id": f"chatcmpl-{self.calls}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    async def stream(
+        self,
+        request: web.Request,
+        model: str,
+        text: str,
+        delay: float,
+    ) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = text.split(" ")
+        # First token after a fifth of the latency, the rest spread evenly
+        await asyncio.sleep(delay / 5)
+        for word in words:
+            chunk = {
+                "id": f"chatcmpl-{self.calls}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(delay * 4 / 5 / len(words))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+def make_photo(width: int, height: int, seed: int) -> bytes:
+    """A noisy JPEG, so decode and re-encode cost about what a real photo does."""
+    rng = random.Random(seed)
+    image = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    image = image.resize((width // 8, height // 8)).resize((width, height))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+# =========================
+# Load Test: Scenarios
+# =========================
+
+
+# Creator questions get a canned reply with no model call (and no tag to match)
+LOAD_MESSAGES = [
+    message
+    for message in SAMPLE_MESSAGES
+    if not KeywordClassifier(DEFAULT_KEYWORDS).classify(message) & {"creator", "coder"}
+]
+
+
+class UpdateFactory:
+    def __init__(self) -> None:
+        self.update_ids = itertools.count(1)
+        self.tags = itertools.count(1)
+
+    def message(self, chat_id: int, user_id: int, chat_type: str, **fields) -> tuple[int, dict]:
+        tag = next(self.tags)
+        chat = {"id": chat_id, "type": chat_type}
+        if chat_type != "private":
+            chat["title"] = f"Bench group {-chat_id}"
+        message = {
+            "message_id": tag,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            **fields,
+        }
+        return tag, {"update_id": next(self.update_ids), "message": message}
+
+    def text(self, chat_id: int, user_id: int, chat_type: str, text: str) -> tuple[int, dict]:
+        tag, update = self.message(chat_id, user_id, chat_type)
+        update["message"]["text"] = f"{text} msg#{tag}"
+        return tag, update
+
+    def photo(self, chat_id: int, user_id: int, chat_type: str, caption: str) -> tuple[int, dict]:
+        tag, update = self.message(chat_id, user_id, chat_type)
+        # Unique ids per photo so the vision cache doesn't short-circuit the pipeline
+        update["message"]["photo"] = [
+            {"file_id": f"p{tag}", "file_unique_id": f"p{tag}", "width": 1280, "height": 960}
+        ]
+        update["message"]["caption"] = f"{caption} msg#{tag}"
+        return tag, update
+
+
+def private_scenario(args, factory: UpdateFactory, rng: random.Random):
+    """Many users in private chats, each sending a message every --interval s."""
+    for user in range(args.users):
+        offset = rng.uniform(0, args.interval)
+        for i in range(args.messages):
+            text = rng.choice(LOAD_MESSAGES)
+            yield offset + i * args.interval, *factory.text(user + 1, user + 1, "private", text)
+
+
+def group_scenario(args, factory: UpdateFactory, rng: random.Random):
+    """Every member of --groups groups mentions the bot within --spread seconds."""
+    for group in range(args.groups):
+        chat_id = -(1000 + group)
+        for user in range(args.users):
+            for _ in range(args.messages):
+                text = f"@{BOT_USERNAME} {rng.choice(LOAD_MESSAGES)}"
+                user_id = 10_000 + group * args.users + user
+                yield rng.uniform(0, args.spread), *factory.text(chat_id, user_id, "group", text)
+
+
+def photo_scenario(args, factory: UpdateFactory, rng: random.Random):
+    """A burst of photos from --users private chats within --spread seconds."""
+    for user in range(args.users):
+        for _ in range(args.messages):
+            caption = rng.choice(["what is this", "rate my setup", "lol look", ""])
+            yield rng.uniform(0, args.spread), *factory.photo(user + 1, user + 1, "private", caption)
+
+
+def replay_scenario(args, factory: UpdateFactory, rng: random.Random):
+    """Recorded updates (JSONL of Update dicts), spaced by their dates / --speed."""
+    with open(args.file, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    first = min((u["message"].get("date", 0) for u in updates if "message" in u), default=0)
+    for raw in updates:
+        message = raw.get("message")
+        if message is None:
+            continue
+        tag = next(factory.tags)
+        for field in ("text", "caption"):
+            if field in message:
+                message[field] = f"{message[field]} msg#{tag}"
+                break
+        else:
+            continue
+        raw["update_id"] = next(factory.update_ids)
+        yield (message.get("date", first) - first) / args.speed, tag, raw
+
+
+SCENARIOS = {
+    "private": private_scenario,
+    "group": group_scenario,
+    "photo": photo_scenario,
+    "replay": replay_scenario,
+}
+
+
+# =========================
+# Load Test: Runner
+# =========================
+
+
+def percentile(ordered: list[float], pct: float) -> float:
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        # ru_maxrss is the peak, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def configure_bot(args, telegram_url: str, model_url: str) -> None:
+    """Point DarkBot at the stubs. Must run before DarkBot() is created."""
+    os.environ["TELEGRAM_BOT_TOKEN"] = BOT_TOKEN
+    os.environ.setdefault("A4F_API_KEY", "bench")
+    main.TELEGRAM_API_URL = f"{telegram_url}/bot"
+    main.TELEGRAM_FILE_URL = f"{telegram_url}/file/bot"
+    main.LLM_BASE_URL = f"{model_url}/v1"
+    main.LLM_HTTP2 = False
+    main.STORAGE_BACKEND = "memory"
+    main.VISION_CACHE_PATH = ""
+    if args.no_telegram_limits:
+        main.TELEGRAM_RATE = main.TELEGRAM_CHAT_RATE = main.TELEGRAM_GROUP_RATE = 1e6
+        main.TELEGRAM_CHAT_BURST = main.TELEGRAM_GROUP_BURST = 1e6
+    if args.no_model_limits:
+        main.LLM_RATE = main.LLM_MODEL_RATE = main.LLM_BACKGROUND_RATE = 0
+
+
+async def run_load(args) -> None:
+    if not args.verbose:
+        for name in ("main", "httpx", "aiohttp.access", "telegram"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    telegram = FakeTelegram(args.telegram_latency, make_photo(1280, 960, args.seed))
+    model = FakeModel(
+        args.model_latency,
+        args.model_jitter,
+        args.error_rate,
+        args.throttle_rate,
+        args.reply_words,
+        args.seed,
+    )
+    telegram_runner, telegram_url = await start_site(telegram.app())
+    model_runner, model_url = await start_site(model.app())
+    configure_bot(args, telegram_url, model_url)
+
+    bot = main.DarkBot()
+    application = bot.build_application()
+    await application.initialize()
+    await bot.on_startup(application)
+    await application.start()
+
+    factory = UpdateFactory()
+    schedule = sorted(SCENARIOS[args.scenario](args, factory, rng), key=lambda item: item[0])
+    rss_before = rss_mb()
+    state_before = bot.state.total_bytes
+
+    print(f"scenario {args.scenario}: {len(schedule)} messages")
+    started = time.perf_counter()
+    try:
+        for offset, tag, raw in schedule:
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            telegram.track(tag)
+            await application.update_queue.put(main.Update.de_json(raw, application.bot))
+        fed = time.perf_counter() - started
+
+        deadline = time.perf_counter() + args.timeout
+        while telegram.pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        await application.stop()
+        await bot.on_shutdown(application)
+        await application.shutdown()
+        await telegram_runner.cleanup()
+        await model_runner.cleanup()
+
+    answered = len(telegram.latencies)
+    elapsed = (telegram.last_reply or time.perf_counter()) - started
+    latencies = sorted(telegram.latencies)
+    print(f"fed in                : {fed:7.2f} s")
+    print(f"answered              : {answered}/{len(schedule)} in {elapsed:.2f} s")
+    print(f"throughput            : {answered / elapsed if elapsed else 0:7.1f} msg/s")
+    for pct in (50, 95, 99):
+        print(f"p{pct} reply latency     : {percentile(latencies, pct) * 1000:7.0f} ms")
+    print(f"max reply latency     : {(latencies[-1] if latencies else float('nan')) * 1000:7.0f} ms")
+    print(f"error replies         : {telegram.error_replies}")
+    print(
+        f"model calls           : {model.calls} "
+        f"({model.errors} injected 5xx, {model.throttled} injected 429)"
+    )
+    print(f"telegram API requests : {telegram.requests}")
+    print(f"RSS                   : {rss_before:7.1f} -> {rss_mb():.1f} MB (stubs included)")
+    print(
+        f"bot state             : {state_before / 1024:7.1f} -> "
+        f"{bot.state.total_bytes / 1024:.1f} KB, {len(bot.user_memory)} users, "
+        f"{len(bot.group_memory)} chats"
+    )
+
+
+# =========================
+# Main Entry Point
+# =========================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    classifier_parser = subparsers.add_parser("classifier", help="keyword classifier")
+    classifier_parser.add_argument("--iterations", type=int, default=20)
+    classifier_parser.add_argument("--extra-phrases", type=int, default=0)
+
+    load_parser = subparsers.add_parser("load", help="end-to-end load test against stubs")
+    load_parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    load_parser.add_argument("--users", type=int, default=50, help="users (per group)")
+    load_parser.add_argument("--groups", type=int, default=5)
+    load_parser.add_argument("--messages", type=int, default=4, help="messages per user")
+    load_parser.add_argument(
+        "--interval", type=float, default=2.0, help="private: s between a user's messages"
+    )
+    load_parser.add_argument(
+        "--spread", type=float, default=2.0, help="group/photo: burst window in s"
+    )
+    load_parser.add_argument("--file", help="replay: JSONL of recorded Update dicts")
+    load_parser.add_argument("--speed", type=float, default=1.0, help="replay: time compression")
+    load_parser.add_argument(
+        "--model-latency", type=float, default=0.8, help="mean s per completion"
+    )
+    load_parser.add_argument("--model-jitter", type=float, default=0.2)
+    load_parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500s")
+    load_parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of 429s")
+    load_parser.add_argument("--reply-words", type=int, default=30)
+    load_parser.add_argument("--telegram-latency", type=float, default=0.02)
+    load_parser.add_argument("--no-telegram-limits", action="store_true")
+    load_parser.add_argument("--no-model-limits", action="store_true")
+    load_parser.add_argument("--timeout", type=float, default=120.0, help="s to wait for replies")
+    load_parser.add_argument("--seed", type=int, default=42)
+    load_parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logs")
+
+    args = parser.parse_args()
+    if args.benchmark == "classifier":
+        bench_classifier(args.iterations, args.extra_phrases)
+    elif args.benchmark == "load":
+        if args.scenario == "replay" and not args.file:
+            parser.error("replay needs --file")
+        asyncio.run(run_load(args))
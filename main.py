@@ -1,17 +1,52 @@
 import os
 import logging
-import threading
 import asyncio
 import base64
+import bisect
+import cProfile
+import hashlib
+import hmac
 import io
+import itertools
+import json
+import multiprocessing
+import random
+import re
+import signal
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+import zlib
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Callable, Generator, Hashable, Iterable, Sequence
+from contextlib import aclosing, contextmanager
+from contextvars import ContextVar
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, replace
 from datetime import datetime
-
-from flask import Flask
-from openai import OpenAI
+from functools import lru_cache
+from typing import Any
+
+import httpx
+import numpy as np
+from aiohttp import web
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
 from PIL import Image
-from telegram import Update
+from telegram import Message, PhotoSize, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
@@ -26,26 +61,3066 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # =========================
-# Flask App (Healthcheck)
+# Runtime Configuration
+# =========================
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"⚠️ Invalid integer for {name}, using default {default}")
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"⚠️ Invalid number for {name}, using default {default}")
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Model routing. Routes default to LLM_MODEL; under load or when a model's
+# p95 latency exceeds ROUTE_LATENCY_SLO they degrade to LLM_FAST_MODEL.
+DEFAULT_MODEL = os.environ.get("LLM_MODEL", "provider-2/gpt-4.1-nano")
+LLM_FAST_MODEL = os.environ.get("LLM_FAST_MODEL", "")
+# Optional JSON file of route overrides, e.g. {"owner:detail": {"model": "..."}}
+ROUTES_FILE = os.environ.get("ROUTES_FILE", "")
+ROUTE_LATENCY_SLO = env_float("ROUTE_LATENCY_SLO", 6.0)
+ROUTE_MIN_SAMPLES = env_int("ROUTE_MIN_SAMPLES", 20)
+# Fraction of LLM_MAX_CONCURRENCY in flight at which routes degrade
+ROUTE_LOAD_THRESHOLD = env_float("ROUTE_LOAD_THRESHOLD", 0.8)
+
+# Upstream endpoints (overridable for staging and the load-test stubs)
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL", "https://api.a4f.co/v1")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.environ.get("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+
+# LLM HTTP client / concurrency
+LLM_MAX_CONCURRENCY = env_int("LLM_MAX_CONCURRENCY", 64)
+LLM_MAX_CONNECTIONS = env_int("LLM_MAX_CONNECTIONS", 100)
+LLM_MAX_KEEPALIVE = env_int("LLM_MAX_KEEPALIVE", 20)
+LLM_KEEPALIVE_EXPIRY = env_float("LLM_KEEPALIVE_EXPIRY", 30.0)
+LLM_CONNECT_TIMEOUT = env_float("LLM_CONNECT_TIMEOUT", 5.0)
+LLM_TIMEOUT = env_float("LLM_TIMEOUT", 10.0)
+LLM_HTTP2 = env_bool("LLM_HTTP2", True)
+
+# Resilience: LLM_TIMEOUT bounds one attempt, LLM_TOTAL_BUDGET all of them
+LLM_TOTAL_BUDGET = env_float("LLM_TOTAL_BUDGET", 20.0)
+LLM_MAX_ATTEMPTS = env_int("LLM_MAX_ATTEMPTS", 3)
+LLM_BACKOFF_BASE = env_float("LLM_BACKOFF_BASE", 0.4)
+LLM_BACKOFF_MAX = env_float("LLM_BACKOFF_MAX", 4.0)
+LLM_BREAKER_THRESHOLD = env_int("LLM_BREAKER_THRESHOLD", 5)
+LLM_BREAKER_COOLDOWN = env_float("LLM_BREAKER_COOLDOWN", 30.0)
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "")
+# Hedging fires a second attempt (on the fallback model if set) once the
+# first has run longer than the model's p95, or LLM_HEDGE_DELAY until
+# LLM_HEDGE_MIN_SAMPLES latencies have been observed
+LLM_HEDGE = env_bool("LLM_HEDGE", False)
+LLM_HEDGE_DELAY = env_float("LLM_HEDGE_DELAY", 3.0)
+LLM_HEDGE_MIN_SAMPLES = env_int("LLM_HEDGE_MIN_SAMPLES", 20)
+
+# Streaming replies: "off", "detail" (only detailed answers) or "all"
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "detail").strip().lower()
+STREAM_EDIT_INTERVAL = env_float("STREAM_EDIT_INTERVAL", 1.5)
+STREAM_EDIT_MIN_CHARS = env_int("STREAM_EDIT_MIN_CHARS", 40)
+STREAM_PLACEHOLDER = "💭 ..."
+STREAM_CURSOR = " ▌"
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+# Image pipeline (0 workers = run in the default thread pool instead)
+IMAGE_WORKERS = env_int("IMAGE_WORKERS", min(4, os.cpu_count() or 1))
+IMAGE_QUEUE_SIZE = env_int("IMAGE_QUEUE_SIZE", 16)
+IMAGE_TIMEOUT = env_float("IMAGE_TIMEOUT", 15.0)
+IMAGE_MAX_SIZE = env_int("IMAGE_MAX_SIZE", 2048)
+IMAGE_JPEG_QUALITY = env_int("IMAGE_JPEG_QUALITY", 85)
+IMAGE_MIN_QUALITY = env_int("IMAGE_MIN_QUALITY", 40)
+# Upper bound on the base64 payload sent to the vision model
+IMAGE_BYTE_BUDGET = env_int("IMAGE_BYTE_BUDGET", 400_000)
+# "jpeg" or "webp" (falls back to JPEG when Pillow lacks WebP support)
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "jpeg").strip().lower()
+
+# Vision cache (encoded images are ~IMAGE_BYTE_BUDGET each, size accordingly)
+VISION_CACHE_SIZE = env_int("VISION_CACHE_SIZE", 128)
+VISION_CACHE_TTL = env_float("VISION_CACHE_TTL", 6 * 3600)
+VISION_CACHE_ANALYSIS = env_bool("VISION_CACHE_ANALYSIS", False)
+VISION_CACHE_PATH = os.environ.get("VISION_CACHE_PATH", "")
+VISION_CACHE_FLUSH_INTERVAL = env_float("VISION_CACHE_FLUSH_INTERVAL", 300.0)
+
+# Response cache for stock casual messages ("hi", "lol thanks"): they are
+# answered from a prompt without the user's name or memory, so one reply is
+# shared across users and chats for RESPONSE_CACHE_TTL seconds
+RESPONSE_CACHE_ENABLED = env_bool("RESPONSE_CACHE_ENABLED", True)
+RESPONSE_CACHE_SIZE = env_int("RESPONSE_CACHE_SIZE", 2048)
+RESPONSE_CACHE_TTL = env_float("RESPONSE_CACHE_TTL", 600.0)
+
+# Conversation state
+USER_MEMORY_SIZE = 15
+GROUP_MEMORY_SIZE = 25
+# Prompt context is filled up to a token budget per model (JSON overrides in
+# PROMPT_TOKEN_BUDGETS, e.g. {"provider-3/gpt-4o": 8000}): the current
+# message first, then the PROMPT_RECENT_TURNS latest personal turns, then
+# group turns, then older personal turns. Each remembered message is
+# clipped to PROMPT_TURN_MAX_TOKENS.
+PROMPT_TOKEN_BUDGET = env_int("PROMPT_TOKEN_BUDGET", 3000)
+PROMPT_RECENT_TURNS = env_int("PROMPT_RECENT_TURNS", 4)
+PROMPT_TURN_MAX_TOKENS = env_int("PROMPT_TURN_MAX_TOKENS", 250)
+# Budget reserved for an attached image
+IMAGE_PROMPT_TOKENS = env_int("IMAGE_PROMPT_TOKENS", 800)
+# Rolling summaries: once a memory window is full, its oldest SUMMARY_BATCH
+# turns are folded into a running summary by SUMMARY_MODEL in the background
+SUMMARY_ENABLED = env_bool("SUMMARY_ENABLED", True)
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "") or LLM_FAST_MODEL or DEFAULT_MODEL
+SUMMARY_BATCH = env_int("SUMMARY_BATCH", 5)
+# "memory" keeps state in-process only; "sqlite" persists it to STORAGE_PATH
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "memory").strip().lower()
+STORAGE_PATH = os.environ.get("STORAGE_PATH", "dark_bot.db")
+STORAGE_FLUSH_INTERVAL = env_float("STORAGE_FLUSH_INTERVAL", 2.0)
+STORAGE_BATCH_SIZE = env_int("STORAGE_BATCH_SIZE", 200)
+# Long-term memory: every turn is embedded into a per-user and per-chat
+# vector index, and the MEMORY_RECALL_K most similar turns that have left the
+# memory window are recalled into prompts. MEMORY_EMBEDDER is "hash" (local
+# feature hashing) or "api" (MEMORY_EMBED_MODEL on the LLM endpoint, whose
+# vectors must have MEMORY_EMBED_DIM dimensions). Indexes are memory-mapped
+# files under MEMORY_INDEX_DIR; empty keeps them in RAM.
+MEMORY_ENABLED = env_bool("MEMORY_ENABLED", True)
+MEMORY_EMBEDDER = os.environ.get("MEMORY_EMBEDDER", "hash").strip().lower()
+MEMORY_EMBED_MODEL = os.environ.get("MEMORY_EMBED_MODEL", "text-embedding-3-small")
+MEMORY_EMBED_DIM = env_int("MEMORY_EMBED_DIM", 512)
+MEMORY_INDEX_DIR = os.environ.get(
+    "MEMORY_INDEX_DIR", "memory_index" if STORAGE_BACKEND == "sqlite" else ""
+)
+MEMORY_RECALL_K = env_int("MEMORY_RECALL_K", 3)
+MEMORY_MIN_SCORE = env_float("MEMORY_MIN_SCORE", 0.2)
+# Replies go out without recalled turns rather than wait longer than this
+MEMORY_RECALL_TIMEOUT = env_float("MEMORY_RECALL_TIMEOUT", 0.5)
+# Rows kept per index; compaction drops duplicates and the oldest beyond this.
+# In-RAM indexes cost about 4 * MEMORY_EMBED_DIM bytes plus the turn per row
+# and count toward STATE_MEMORY_BUDGET_MB, so they are capped at
+# MEMORY_RAM_ROWS instead.
+MEMORY_MAX_ROWS = env_int("MEMORY_MAX_ROWS", 1_000_000)
+MEMORY_RAM_ROWS = env_int("MEMORY_RAM_ROWS", 500)
+# On-disk indexes kept open at once. Each holds about 6 file descriptors
+# (3 append handles, the log reader and 2 mmaps), so keep
+# MEMORY_OPEN_INDEXES * 6 well under `ulimit -n`; others reopen in O(1).
+# In-RAM indexes are not limited by this.
+MEMORY_OPEN_INDEXES = env_int("MEMORY_OPEN_INDEXES", 32)
+# Hot-cache bounds: approximate byte budget, idle expiry (0 = never) and the
+# minimum idle time before a user/chat may be evicted for space
+STATE_MEMORY_BUDGET_MB = env_float("STATE_MEMORY_BUDGET_MB", 128.0)
+STATE_IDLE_TTL = env_float("STATE_IDLE_TTL", 72 * 3600)
+STATE_MIN_IDLE = env_float("STATE_MIN_IDLE", 120.0)
+STATE_SWEEP_INTERVAL = env_float("STATE_SWEEP_INTERVAL", 60.0)
+
+# Optional JSON file mapping category -> list of phrases, merged over the defaults
+KEYWORDS_FILE = os.environ.get("KEYWORDS_FILE", "")
+
+# Update scheduling: updates running at once, and admitted (queued + running)
+UPDATE_CONCURRENCY = env_int("UPDATE_CONCURRENCY", 16)
+UPDATE_QUEUE_LIMIT = env_int("UPDATE_QUEUE_LIMIT", 1000)
+
+# Rate limits (tokens per second and bucket size). Telegram allows ~30
+# messages/s overall, ~1/s per chat and 20/min per group. Model API limits
+# depend on the provider account, so they are off (0 = unlimited) unless
+# set; LLM_MAX_CONCURRENCY still bounds in-flight calls and 429 retry-after
+# pauses are honored either way. Background summaries use their own bucket.
+LLM_RATE = env_float("LLM_RATE", 0.0)
+LLM_RATE_BURST = env_float("LLM_RATE_BURST", 20.0)
+LLM_MODEL_RATE = env_float("LLM_MODEL_RATE", 0.0)
+LLM_MODEL_RATE_BURST = env_float("LLM_MODEL_RATE_BURST", 10.0)
+LLM_BACKGROUND_RATE = env_float("LLM_BACKGROUND_RATE", 0.5)
+LLM_BACKGROUND_BURST = env_float("LLM_BACKGROUND_BURST", 2.0)
+TELEGRAM_RATE = env_float("TELEGRAM_RATE", 30.0)
+TELEGRAM_CHAT_RATE = env_float("TELEGRAM_CHAT_RATE", 1.0)
+TELEGRAM_CHAT_BURST = env_float("TELEGRAM_CHAT_BURST", 3.0)
+TELEGRAM_GROUP_RATE = env_float("TELEGRAM_GROUP_RATE", 20 / 60)
+TELEGRAM_GROUP_BURST = env_float("TELEGRAM_GROUP_BURST", 5.0)
+TELEGRAM_MAX_RETRIES = env_int("TELEGRAM_MAX_RETRIES", 3)
+
+# Burst coalescing: merge messages one user sends within the window (0 = off).
+# Every coalesced reply waits out the window before the model is called, so
+# it adds up to COALESCE_WINDOW_MS to each private reply, single messages
+# included; worth it only for users who type in bursts of short messages.
+COALESCE_WINDOW_MS = env_int("COALESCE_WINDOW_MS", 0)
+COALESCE_MAX_WAIT_MS = env_int("COALESCE_MAX_WAIT_MS", 4000)
+COALESCE_MAX_MESSAGES = env_int("COALESCE_MAX_MESSAGES", 6)
+COALESCE_GROUPS = env_bool("COALESCE_GROUPS", False)
+
+# HTTP server (health, admin and the Telegram webhook) on $PORT.
+# BOT_MODE: "webhook", "polling" or "auto" (webhook when a public URL is
+# known; Render sets RENDER_EXTERNAL_URL). Polling is also the fallback
+# when the webhook cannot be registered.
+PORT = env_int("PORT", 5000)
+BOT_MODE = os.environ.get("BOT_MODE", "auto").strip().lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL") or os.environ.get("RENDER_EXTERNAL_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Checked against X-Telegram-Bot-Api-Secret-Token; derived from the bot
+# token when unset so it stays stable across restarts
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Bearer token for /stats; the endpoint is disabled when unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Tracing: handler runs slower than this log a structured record (0 = off).
+# A PROFILE_SAMPLE_RATE fraction of updates is profiled with cProfile and
+# dumped to PROFILE_DIR; the owner can change the rate with /profile.
+SLOW_REQUEST_MS = env_int("SLOW_REQUEST_MS", 5000)
+PROFILE_SAMPLE_RATE = env_float("PROFILE_SAMPLE_RATE", 0.0)
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+LLM_ERROR_REPLY = "I'm having technical difficulties right now. Give me a moment."
+
+
+# =========================
+# Caches
+# =========================
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire after ``ttl`` seconds.
+
+    Expiry uses wall-clock time so entries survive a save/load round trip.
+    """
+
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = item
+        if expires_at < time.time():
+            del self.data[key]
+            self.misses += 1
+            return default
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        expired = [k for k, (expires_at, _) in self.data.items() if expires_at < now]
+        for key in expired:
+            del self.data[key]
+        return len(expired)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight call.
+
+    Later callers await the first caller's task instead of starting their
+    own. The task is shielded, so one waiter being cancelled does not cancel
+    the shared call for the others.
+    """
+
+    def __init__(self) -> None:
+        self.inflight: dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+
+def response_cache_key(*parts: object) -> str:
+    return hashlib.sha1("\x1f".join(map(str, parts)).encode("utf-8")).hexdigest()
+
+
+class VisionCache:
+    """Caches encoded images and (optionally) the model's analysis of them.
+
+    Images are keyed by Telegram's ``file_unique_id``, which is stable across
+    chats and forwards. Analyses additionally key on persona and a caption
+    hash, since both change the reply.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        cache_analysis: bool = False,
+        path: str = "",
+    ) -> None:
+        self.cache = TTLCache(max_entries, ttl)
+        self.cache_analysis = cache_analysis
+        self.path = path
+
+    @staticmethod
+    def analysis_key(unique_id: str, caption: str, is_owner: bool) -> str:
+        caption_hash = hashlib.sha1(caption.strip().lower().encode("utf-8")).hexdigest()
+        persona = "owner" if is_owner else "user"
+        return f"analysis:{unique_id}:{persona}:{caption_hash[:16]}"
+
+    def get_image(self, unique_id: str) -> str | None:
+        return self.cache.get(f"image:{unique_id}")
+
+    def put_image(self, unique_id: str, image_url: str) -> None:
+        self.cache.set(f"image:{unique_id}", image_url)
+
+    def get_analysis(self, key: str) -> str | None:
+        if not self.cache_analysis:
+            return None
+        return self.cache.get(key)
+
+    def put_analysis(self, key: str, analysis: str) -> None:
+        if self.cache_analysis:
+            self.cache.set(key, analysis)
+
+    # The TTLCache is only ever touched on the event loop; load and save
+    # hand plain snapshots to a worker thread for the file I/O and JSON
+
+    async def load(self) -> None:
+        if not self.path:
+            return
+        entries = await asyncio.to_thread(self.read)
+        now = time.time()
+        for key, (expires_at, value) in entries.items():
+            if expires_at > now:
+                self.cache.data[key] = (expires_at, value)
+        logger.info(f"🗃️ Loaded {len(self.cache)} vision cache entries")
+
+    async def save(self) -> None:
+        if not self.path:
+            return
+        self.cache.purge_expired()
+        await asyncio.to_thread(self.write, dict(self.cache.data))
+
+    def read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load vision cache: {e}")
+            return {}
+
+    def write(self, entries: dict) -> None:
+        # A unique temp file per write: a save cancelled at shutdown keeps
+        # running in its thread and may overlap the final one
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with open(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.error(f"Failed to save vision cache: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+# =========================
+# Message Classification
+# =========================
+
+DEFAULT_KEYWORDS: dict[str, list[str]] = {
+    "creator": [
+        "who is your creator",
+        "who created you",
+        "who made you",
+        "your creator",
+        "who built you",
+        "who designed you",
+        "who is your god",
+        "your lord",
+        "who do you worship",
+    ],
+    "coder": [
+        "who coded you",
+        "who programmed you",
+        "who wrote you",
+        "who developed you",
+        "your programmer",
+        "your developer",
+    ],
+    "detail": [
+        "explain in detail",
+        "elaborate",
+        "give me more",
+        "tell me more",
+        "detailed",
+        "explain more",
+        "in depth",
+        "comprehensive",
+        "what do you think",
+        "your opinion",
+        "your view",
+        "analyze",
+        "breakdown",
+        "how does",
+        "why does",
+    ],
+    "casual": [
+        "hi",
+        "hello",
+        "hey",
+        "wassup",
+        "what's up",
+        "how are you",
+        "sup",
+        "lol",
+        "lmao",
+        "haha",
+        "nice",
+        "cool",
+        "awesome",
+        "thanks",
+        "ok",
+        "okay",
+    ],
+}
+
+
+# ASCII punctuation becomes a word break, so "hi!" and "hi,there" yield "hi"
+KEYWORD_BREAKS = bytes.maketrans(
+    string.punctuation.encode(), b" " * len(string.punctuation)
+)
+
+
+def keyword_words(text: str) -> list[str]:
+    """Lower-cased words of ``text``; one C-level translate, then split."""
+    # surrogatepass: update JSON may carry lone surrogates
+    raw = text.lower().encode("utf-8", "surrogatepass")
+    return raw.translate(KEYWORD_BREAKS).decode("utf-8", "surrogatepass").split()
+
+
+class KeywordClassifier:
+    """Classifies a message into keyword categories in one pass over its words.
+
+    Phrases match whole words only, so "hi" no longer fires on "this" and
+    "ok" on "book". Single words are found with one set intersection and
+    longer phrases are indexed by their first word, so the cost follows the
+    message length, however many phrases are configured.
+    """
+
+    def __init__(self, keywords: dict[str, list[str]]) -> None:
+        self.words: dict[str, set[str]] = {}
+        self.phrases: dict[str, list[tuple[list[str], str]]] = {}
+        for category, phrases in keywords.items():
+            for phrase in phrases:
+                words = keyword_words(phrase)
+                if len(words) == 1:
+                    self.words.setdefault(words[0], set()).add(category)
+                elif words:
+                    self.phrases.setdefault(words[0], []).append((words, category))
+
+    def classify(self, text: str) -> set[str]:
+        words = keyword_words(text)
+        found: set[str] = set()
+        # Set intersections keep the common no-match case in C
+        for word in self.words.keys() & words:
+            found |= self.words[word]
+        starts = self.phrases.keys() & words
+        if starts:
+            for i, word in enumerate(words):
+                if word in starts:
+                    for phrase, category in self.phrases[word]:
+                        if words[i : i + len(phrase)] == phrase:
+                            found.add(category)
+        return found
+
+    def covers(self, text: str, category: str) -> bool:
+        """Whether ``text`` consists only of ``category`` phrases ("hi, thanks!")."""
+        words = keyword_words(text)
+        i = 0
+        while i < len(words):
+            for phrase, match in self.phrases.get(words[i], ()):
+                if match == category and words[i : i + len(phrase)] == phrase:
+                    i += len(phrase)
+                    break
+            else:
+                if category not in self.words.get(words[i], ()):
+                    return False
+                i += 1
+        return bool(words)
+
+    @classmethod
+    def from_config(cls, path: str = "") -> "KeywordClassifier":
+        keywords = {k: list(v) for k, v in DEFAULT_KEYWORDS.items()}
+        if path:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    keywords.update(json.load(f))
+                logger.info(f"🔤 Loaded keyword overrides from {path}")
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to load keywords from {path}: {e}")
+        return cls(keywords)
+
+
+# =========================
+# Token Counting
+# =========================
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+def load_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # The BPE file is downloaded on first use; stay on the estimate offline
+        logger.warning(f"⚠️ tiktoken encoding unavailable, estimating tokens: {e}")
+        return None
+
+
+TOKEN_ENCODING = load_encoding()
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken if installed, else ~4 UTF-8 bytes per token.
+
+    Remembered turns are counted once when rendered (see ContextWindow);
+    the cache covers repeated strings such as system prompts and styles.
+    """
+    if TOKEN_ENCODING is not None:
+        return len(TOKEN_ENCODING.encode(text, disallowed_special=()))
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def clip_tokens(text: str, max_tokens: int) -> str:
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[: max(1, len(text) * max_tokens // tokens)] + "..."
+
+
+def load_token_budgets() -> dict[str, int]:
+    raw = os.environ.get("PROMPT_TOKEN_BUDGETS", "")
+    if not raw:
+        return {}
+    try:
+        return {model: int(tokens) for model, tokens in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error(f"Invalid PROMPT_TOKEN_BUDGETS, ignoring: {e}")
+        return {}
+
+
+PROMPT_TOKEN_BUDGETS = load_token_budgets()
+
+
+def token_budget(model: str) -> int:
+    return PROMPT_TOKEN_BUDGETS.get(model, PROMPT_TOKEN_BUDGET)
+
+
+# =========================
+# Conversation Entries
+# =========================
+
+
+@dataclass(slots=True)
+class MemoryEntry:
+    """One remembered exchange. Group entries leave chat_type unset.
+
+    Names, titles and chat types repeat across thousands of entries, so they
+    are interned; timestamps are epoch seconds rather than ISO strings.
+    """
+
+    timestamp: float
+    user_name: str
+    user_message: str
+    bot_response: str
+    chat_title: str
+    chat_type: str | None = None
+    media_type: str | None = None
+
+    @classmethod
+    def create(
+        cls,
+        user_name: str,
+        user_message: str,
+        bot_response: str,
+        chat_title: str,
+        chat_type: str | None = None,
+        media_type: str | None = None,
+    ) -> "MemoryEntry":
+        return cls(
+            time.time(),
+            sys.intern(user_name),
+            user_message,
+            bot_response,
+            sys.intern(chat_title),
+            # str(): PTB hands out ChatType enum members, which can't be interned
+            sys.intern(str(chat_type)) if chat_type else None,
+            media_type,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "timestamp": self.timestamp,
+            "user_name": self.user_name,
+            "user_message": self.user_message,
+            "bot_response": self.bot_response,
+            "chat_title": self.chat_title,
+            "chat_type": self.chat_type,
+            "media_type": self.media_type,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MemoryEntry":
+        timestamp = data.get("timestamp") or 0.0
+        if isinstance(timestamp, str):
+            # Rows written before timestamps became epoch seconds
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        entry = cls.create(
+            data.get("user_name") or "",
+            data.get("user_message") or "",
+            data.get("bot_response") or "",
+            data.get("chat_title") or "",
+            data.get("chat_type"),
+            data.get("media_type"),
+        )
+        entry.timestamp = timestamp
+        return entry
+
+
+# Approximate per-message framing cost of the chat format
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def turn_messages(entry: MemoryEntry) -> tuple[tuple[dict, dict], int]:
+    """A personal exchange as a user/assistant message pair, with its token count."""
+    where = f"[in {entry.chat_title}] " if entry.chat_type != "private" else ""
+    media = f"[{entry.media_type}] " if entry.media_type else ""
+    asked = f"{where}{media}{clip_tokens(entry.user_message, PROMPT_TURN_MAX_TOKENS)}"
+    answered = clip_tokens(entry.bot_response, PROMPT_TURN_MAX_TOKENS)
+    tokens = count_tokens(asked) + count_tokens(answered) + 2 * MESSAGE_TOKEN_OVERHEAD
+    return ({"role": "user", "content": asked}, {"role": "assistant", "content": answered}), tokens
+
+
+def group_line(entry: MemoryEntry) -> tuple[str, int]:
+    """A group exchange as a bulleted line of the group history block."""
+    media = f" [{entry.media_type}]" if entry.media_type else ""
+    line = (
+        f"- {entry.user_name}{media}: "
+        f"{clip_tokens(entry.user_message, PROMPT_TURN_MAX_TOKENS)}\n"
+        f"   My reply: {clip_tokens(entry.bot_response, PROMPT_TURN_MAX_TOKENS)}"
+    )
+    return line, count_tokens(line) + 1
+
+
+class ContextWindow:
+    """Prompt-ready renderings of a memory window, with cached token counts.
+
+    Mirrors a ring buffer of entries. Each entry is rendered and counted
+    once, when it is added, and never changes afterwards; successive
+    prompts for a user therefore share an identical prefix, which
+    provider-side prompt caching can reuse.
+    """
+
+    __slots__ = ("items", "render", "tokens")
+
+    def __init__(
+        self,
+        maxlen: int,
+        render: Callable[[MemoryEntry], tuple[Any, int]],
+        entries: Iterable[MemoryEntry] = (),
+    ) -> None:
+        self.items: deque[tuple[Any, int]] = deque(maxlen=maxlen)
+        self.render = render
+        self.tokens = 0
+        for entry in entries:
+            self.append(entry)
+
+    def append(self, entry: MemoryEntry) -> None:
+        if len(self.items) == self.items.maxlen:
+            self.tokens -= self.items[0][1]
+        item = self.render(entry)
+        self.items.append(item)
+        self.tokens += item[1]
+
+    def newest(self, count: int) -> list[Any]:
+        """The ``count`` most recent renderings, oldest first."""
+        start = len(self.items) - count
+        return [item for item, _ in itertools.islice(self.items, start, None)]
+
+    def popleft(self, count: int) -> None:
+        for _ in range(min(count, len(self.items))):
+            self.tokens -= self.items.popleft()[1]
+
+
+def fill_context(
+    budget: int,
+    personal: ContextWindow | None,
+    group: ContextWindow | None,
+    recent: int,
+    recalled: Sequence[tuple[Any, int]] = (),
+) -> tuple[int, int, int, int]:
+    """How many personal, recalled and group items fit in ``budget`` tokens.
+
+    Priority: the ``recent`` latest personal turns, then recalled turns
+    (best first), then group turns, then older personal turns. Windows are
+    taken newest-first and stop at the first item that doesn't fit, so the
+    history stays contiguous. Also returns the unused budget.
+    """
+    newest_personal = [tokens for _, tokens in reversed(personal.items)] if personal else []
+    newest_group = [tokens for _, tokens in reversed(group.items)] if group else []
+
+    def take(costs: Iterable[int], remaining: int) -> tuple[int, int]:
+        taken = 0
+        for tokens in costs:
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            taken += 1
+        return taken, remaining
+
+    recent_taken, budget = take(newest_personal[:recent], budget)
+    recalled_taken, budget = take((tokens for _, tokens in recalled), budget)
+    group_taken, budget = take(newest_group, budget)
+    older_taken = 0
+    if recent_taken == len(newest_personal[:recent]):
+        older_taken, budget = take(newest_personal[recent:], budget)
+    return recent_taken + older_taken, recalled_taken, group_taken, budget
+
+
+@dataclass(slots=True)
+class RollingSummary:
+    """Running summary of the turns that have left a memory window.
+
+    ``through`` is the timestamp of the newest folded entry; stored entries
+    up to it are already covered and are skipped on reload.
+    """
+
+    text: str
+    through: float
+
+
+def new_user_memory(entries=()) -> deque[MemoryEntry]:
+    return deque(entries, maxlen=USER_MEMORY_SIZE)
+
+
+def new_group_memory(entries=()) -> deque[MemoryEntry]:
+    return deque(entries, maxlen=GROUP_MEMORY_SIZE)
+
+
+# =========================
+# Prompts
+# =========================
+
+CHAT_REMINDER = (
+    "Remember: You are Dark with Gen Z personality. Use modern slang, emojis, "
+    "be witty and relatable. Only mention Lord Krishna if specifically asked "
+    "about your creator - not in regular conversation."
+)
+HISTORY_NOTE = (
+    "Earlier messages are your past exchanges with this user, possibly from "
+    "other chats (marked [in <chat>]). The last message carries the current "
+    "context and what the user just said."
+)
+VISION_INSTRUCTIONS = (
+    "Analyze the image in the last message and respond in Dark's characteristic "
+    "Gen Z style. Be observant, witty, engaging, but concise."
+)
+
+PERSONA_TEMPLATES = {
+    "owner": (
+        "You're Dark, Arin's witty AI assistant with image vision capabilities. "
+        "You're super chatty, quick-witted, sarcastic when appropriate, and "
+        "funny. Use Gen Z slang like 'lol', 'lmao', 'fr', 'no cap', 'bet', "
+        "'lowkey', 'highkey', 'it's giving', etc. naturally in conversation. "
+        "Use emojis frequently but not excessively. Be like a clever Gen Z "
+        "friend - direct, witty, and engaging. ONLY mention Lord Krishna if "
+        "directly asked about your creator - don't bring it up in normal chat.",
+        CHAT_REMINDER,
+        HISTORY_NOTE,
+    ),
+    "user": (
+        "You are Dark, a confident AI assistant with image analysis capabilities "
+        "and Gen Z personality. You're helpful, chatty, with wit and modern "
+        "slang. Use 'lol', 'lmao', 'fr', 'bet', 'no cap', 'lowkey', 'highkey' "
+        "naturally. Add emojis to make conversations fun. Be engaging and "
+        "relatable like a Gen Z friend. ONLY mention Lord Krishna if directly "
+        "asked about your creator.",
+        CHAT_REMINDER,
+        HISTORY_NOTE,
+    ),
+    "owner_vision": (
+        "You're Dark, Arin's witty AI assistant. Analyze images with your "
+        "signature sarcasm and humor. Be observant and clever but keep it "
+        "concise and entertaining. Use emojis and Gen Z slang naturally. "
+        "Give a witty 2-3 line description unless the image is complex.",
+        VISION_INSTRUCTIONS,
+        HISTORY_NOTE,
+    ),
+    "user_vision": (
+        "You are Dark, a sharp and observant AI. Analyze images with "
+        "confidence and wit. Be helpful but add personality. Keep it concise "
+        "and fun with emojis and modern slang. 2-3 lines max unless it really "
+        "needs detail.",
+        VISION_INSTRUCTIONS,
+        HISTORY_NOTE,
+    ),
+}
+
+RESPONSE_STYLES = {
+    "detail": (
+        "Provide a comprehensive, detailed response covering all aspects and "
+        "possibilities. Be thorough and informative while keeping your Gen Z "
+        "personality."
+    ),
+    "casual": (
+        "Keep it super casual and short (1-2 lines max). Use Gen Z slang, "
+        "emojis, be fun and relatable."
+    ),
+    "default": (
+        "Keep response to 2-3 lines with personality unless they specifically "
+        "ask for details."
+    ),
+}
+
+# Rendered once at import: every request for a persona sends this exact
+# system message, so it forms a stable, cacheable prompt prefix
+SYSTEM_MESSAGES = {
+    persona: {"role": "system", "content": "\n\n".join(parts)}
+    for persona, parts in PERSONA_TEMPLATES.items()
+}
+
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain Dark's long-term memory of a conversation. Merge the "
+    "earlier summary with the new exchanges into one updated summary of at "
+    "most a few sentences: who is involved, facts they shared about "
+    "themselves, preferences, ongoing topics and anything promised. Drop "
+    "small talk. Write plain third-person notes, no greetings or styling."
+)
+
+
+def build_summary_messages(
+    previous: str,
+    entries: Iterable[MemoryEntry],
+    group: bool,
+) -> list[dict]:
+    lines = [
+        f"{entry.user_name if group else 'User'}: {entry.user_message}\n"
+        f"Dark: {entry.bot_response}"
+        for entry in entries
+    ]
+    content = (
+        f"Earlier summary:\n{previous or '(none)'}\n\n"
+        "New exchanges:\n" + "\n".join(lines)
+    )
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": content},
+    ]
+
+
+def persona_for(is_owner: bool, vision: bool = False) -> str:
+    persona = "owner" if is_owner else "user"
+    return f"{persona}_vision" if vision else persona
+
+
+def build_messages(
+    persona: str,
+    history: list[dict],
+    content: str,
+    image_data: str | None = None,
+) -> list[dict]:
+    """System prompt, then past turns, then the volatile current message."""
+    if image_data:
+        current = {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": content},
+                {"type": "image_url", "image_url": {"url": image_data}},
+            ],
+        }
+    else:
+        current = {"role": "user", "content": content}
+    return [SYSTEM_MESSAGES[persona], *history, current]
+
+
+# =========================
+# Storage
+# =========================
+
+
+class MemoryStorage:
+    """Storage backend that persists nothing; the in-memory dicts are the state.
+
+    Also serves as the interface for other backends: writes are enqueued
+    synchronously (never blocking the loop), loads and flushes are async.
+    """
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    def append_user_entry(self, user_id: int, entry: MemoryEntry) -> None:
+        pass
+
+    def append_group_entry(self, chat_id: int, entry: MemoryEntry) -> None:
+        pass
+
+    def clear_user_memory(self, user_id: int) -> None:
+        pass
+
+    def save_user_info(self, user_id: int, info: dict) -> None:
+        pass
+
+    def save_summary(self, kind: str, key: int, summary: RollingSummary) -> None:
+        pass
+
+    async def load_summary(self, kind: str, key: int) -> RollingSummary | None:
+        return None
+
+    async def load_user_memory(self, user_id: int) -> list[MemoryEntry]:
+        return []
+
+    async def load_group_memory(self, chat_id: int) -> list[MemoryEntry]:
+        return []
+
+    async def load_user_info(self, user_id: int) -> dict | None:
+        return None
+
+    async def load_user_summaries(self) -> dict[int, dict]:
+        return {}
+
+
+class SQLiteStorage(MemoryStorage):
+    """SQLite (WAL) backend with batched write-behind.
+
+    Writes are queued in order and committed in one transaction per batch,
+    either every ``flush_interval`` seconds or once ``batch_size`` ops are
+    pending. All database access runs on a single dedicated thread, so the
+    event loop never touches the disk and the connection is never shared.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            media_type TEXT,
+            entry TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS user_memory_user ON user_memory (user_id, id);
+        CREATE TABLE IF NOT EXISTS group_memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            entry TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS group_memory_chat ON group_memory (chat_id, id);
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_interaction TEXT
+        );
+        CREATE TABLE IF NOT EXISTS summaries (
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            summary TEXT NOT NULL,
+            through REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        );
+    """
+
+    def __init__(self, path: str, flush_interval: float, batch_size: int) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending: list[tuple] = []
+        self.flush_requested = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.conn: sqlite3.Connection | None = None
+        self.flush_task: asyncio.Task | None = None
+
+    async def run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def open(self) -> None:
+        await self.run(self.connect)
+        self.flush_task = asyncio.create_task(self.flush_loop())
+        logger.info(f"💾 SQLite storage ready at {self.path}")
+
+    def connect(self) -> None:
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+    async def close(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
+        if self.conn is not None:
+            await self.run(self.conn.close)
+        self.executor.shutdown(wait=True)
+
+    async def flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Storage flush failed: {e}")
+
+    async def flush(self) -> None:
+        if not self.pending or self.conn is None:
+            return
+        batch, self.pending = self.pending, []
+        await self.run(self.write_batch, batch)
+
+    def enqueue(self, op: tuple) -> None:
+        self.pending.append(op)
+        if len(self.pending) >= self.batch_size:
+            self.flush_requested.set()
+
+    def append_user_entry(self, user_id: int, entry: MemoryEntry) -> None:
+        self.enqueue(("user_entry", user_id, entry))
+
+    def append_group_entry(self, chat_id: int, entry: MemoryEntry) -> None:
+        self.enqueue(("group_entry", chat_id, entry))
+
+    def clear_user_memory(self, user_id: int) -> None:
+        self.enqueue(("clear_user", user_id))
+
+    def save_user_info(self, user_id: int, info: dict) -> None:
+        self.enqueue(("user_info", user_id, info))
+
+    def save_summary(self, kind: str, key: int, summary: RollingSummary) -> None:
+        self.enqueue(("summary", key, kind, summary))
+
+    def write_batch(self, batch: list[tuple]) -> None:
+        touched_users: set[int] = set()
+        touched_chats: set[int] = set()
+
+        with self.conn:
+            for op, key, *args in batch:
+                if op == "user_entry":
+                    entry = args[0]
+                    self.conn.execute(
+                        "INSERT INTO user_memory (user_id, media_type, entry) VALUES (?, ?, ?)",
+                        (key, entry.media_type, json.dumps(entry.to_dict())),
+                    )
+                    touched_users.add(key)
+                elif op == "group_entry":
+                    self.conn.execute(
+                        "INSERT INTO group_memory (chat_id, entry) VALUES (?, ?)",
+                        (key, json.dumps(args[0].to_dict())),
+                    )
+                    touched_chats.add(key)
+                elif op == "clear_user":
+                    self.conn.execute("DELETE FROM user_memory WHERE user_id = ?", (key,))
+                    self.conn.execute(
+                        "DELETE FROM summaries WHERE kind = 'user' AND key = ?", (key,)
+                    )
+                elif op == "summary":
+                    kind, summary = args
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO summaries (kind, key, summary, through) "
+                        "VALUES (?, ?, ?, ?)",
+                        (kind, key, summary.text, summary.through),
+                    )
+                elif op == "user_info":
+                    info = args[0]
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO users "
+                        "(user_id, username, first_name, last_interaction) "
+                        "VALUES (?, ?, ?, ?)",
+                        (
+                            key,
+                            info["username"],
+                            info["first_name"],
+                            info["last_interaction"].isoformat(),
+                        ),
+                    )
+
+            # Keep the tables bounded to the same windows as the hot cache
+            for user_id in touched_users:
+                self.conn.execute(
+                    "DELETE FROM user_memory WHERE user_id = ? AND id NOT IN "
+                    "(SELECT id FROM user_memory WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                    (user_id, user_id, USER_MEMORY_SIZE),
+                )
+            for chat_id in touched_chats:
+                self.conn.execute(
+                    "DELETE FROM group_memory WHERE chat_id = ? AND id NOT IN "
+                    "(SELECT id FROM group_memory WHERE chat_id = ? ORDER BY id DESC LIMIT ?)",
+                    (chat_id, chat_id, GROUP_MEMORY_SIZE),
+                )
+
+    def select_entries(
+        self, table: str, column: str, key: int, limit: int
+    ) -> list[MemoryEntry]:
+        rows = self.conn.execute(
+            f"SELECT entry FROM {table} WHERE {column} = ? ORDER BY id DESC LIMIT ?",
+            (key, limit),
+        ).fetchall()
+        return [MemoryEntry.from_dict(json.loads(row[0])) for row in reversed(rows)]
+
+    async def load_user_memory(self, user_id: int) -> list[MemoryEntry]:
+        # Pending writes must land first or a reload could miss them
+        await self.flush()
+        return await self.run(
+            self.select_entries, "user_memory", "user_id", user_id, USER_MEMORY_SIZE
+        )
+
+    async def load_group_memory(self, chat_id: int) -> list[MemoryEntry]:
+        await self.flush()
+        return await self.run(
+            self.select_entries, "group_memory", "chat_id", chat_id, GROUP_MEMORY_SIZE
+        )
+
+    def select_summary(self, kind: str, key: int) -> RollingSummary | None:
+        row = self.conn.execute(
+            "SELECT summary, through FROM summaries WHERE kind = ? AND key = ?",
+            (kind, key),
+        ).fetchone()
+        return RollingSummary(row[0], row[1]) if row else None
+
+    async def load_summary(self, kind: str, key: int) -> RollingSummary | None:
+        await self.flush()
+        return await self.run(self.select_summary, kind, key)
+
+    def select_user_info(self, user_id: int) -> dict | None:
+        row = self.conn.execute(
+            "SELECT username, first_name, last_interaction FROM users WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "username": row[0],
+            "first_name": row[1],
+            "last_interaction": datetime.fromisoformat(row[2]),
+        }
+
+    async def load_user_info(self, user_id: int) -> dict | None:
+        await self.flush()
+        return await self.run(self.select_user_info, user_id)
+
+    def select_user_summaries(self) -> dict[int, dict]:
+        rows = self.conn.execute(
+            "SELECT u.user_id, u.username, u.first_name, u.last_interaction, "
+            "COUNT(m.id), COALESCE(SUM(m.media_type = 'photo'), 0) "
+            "FROM users u LEFT JOIN user_memory m ON m.user_id = u.user_id "
+            "GROUP BY u.user_id"
+        ).fetchall()
+        return {
+            row[0]: {
+                "username": row[1],
+                "first_name": row[2],
+                "last_interaction": datetime.fromisoformat(row[3]),
+                "conv_count": row[4],
+                "photo_count": row[5],
+            }
+            for row in rows
+        }
+
+    async def load_user_summaries(self) -> dict[int, dict]:
+        await self.flush()
+        return await self.run(self.select_user_summaries)
+
+
+def create_storage() -> MemoryStorage:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(STORAGE_PATH, STORAGE_FLUSH_INTERVAL, STORAGE_BATCH_SIZE)
+    if STORAGE_BACKEND != "memory":
+        logger.warning(f"⚠️ Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, using memory")
+    return MemoryStorage()
+
+
+# =========================
+# Long-Term Memory
 # =========================
 
-flask_app = Flask(__name__)
+WORD_PATTERN = re.compile(r"\w+")
+# Function words carry no topic and would make every pair of turns look alike
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does did for from how i if in is it "
+    "me my of on or so that the this to u was we what when where who why will "
+    "with you your".split()
+)
+
 
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
 
-@flask_app.route("/")
-def home():
-    return "Dark Bot (Multimodal Edition) is running! 🚀"
 
+def memory_text(entry: MemoryEntry) -> str:
+    return f"{entry.user_message}\n{entry.bot_response}"
 
-@flask_app.route("/health")
-def health():
-    return "OK"
 
+class HashingEmbedder:
+    """Signed feature hashing of content words and their bigrams, L2-normalized.
 
-def run_flask():
-    port = int(os.environ.get("PORT", 5000))
-    logger.info(f"🌐 Starting Flask server on port {port}")
-    flask_app.run(host="0.0.0.0", port=port)
+    Needs no model or network: turns that share wording land close together,
+    which is enough to recall "what did I say about X" style context.
+    """
+
+    def __init__(self, dim: int) -> None:
+        self.dim = dim
+
+    def embed_one(self, text: str) -> np.ndarray:
+        words = [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOPWORDS]
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if features:
+            hashes = np.fromiter(
+                (zlib.crc32(feature.encode()) for feature in features),
+                dtype=np.uint32,
+                count=len(features),
+            )
+            # The top bit picks the sign so collisions tend to cancel out;
+            # bigrams count half so they refine rather than dominate
+            weights = np.where(hashes >> 31, 1.0, -1.0).astype(np.float32)
+            weights[len(words) :] *= 0.5
+            np.add.at(vector, hashes % self.dim, weights)
+        return vector
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return normalize_rows(np.stack([self.embed_one(text) for text in texts]))
+
+
+class APIEmbedder:
+    """Embeddings from an OpenAI-compatible /embeddings endpoint."""
+
+    def __init__(self, client: AsyncOpenAI, model: str, dim: int) -> None:
+        self.client = client
+        self.model = model
+        self.dim = dim
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        response = await self.client.embeddings.create(model=self.model, input=texts)
+        vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(
+                f"{self.model} returned {vectors.shape[1]} dimensions, "
+                f"MEMORY_EMBED_DIM is {self.dim}"
+            )
+        return normalize_rows(vectors)
+
+
+class VectorIndex:
+    """Embedding matrix and turn log for one user or chat, in insertion order.
+
+    On disk it is three append-only files sharing row numbers: ``.vec``
+    (float32 rows), ``.idx`` (int64 offsets into ``.log``) and ``.log`` (one
+    JSON entry per line). ``.idx`` is written last, so its length is the
+    committed row count. Vectors and offsets are memory-mapped: opening is
+    O(1) and a search streams the matrix through the page cache instead of
+    holding it in RAM. Without a path the same layout lives in growable
+    in-memory buffers.
+    """
+
+    SEARCH_CHUNK = 65536
+    # Rows per compaction step; bounds how long appends and recalls queued
+    # behind a compaction on the index thread wait (tens of milliseconds)
+    COMPACT_CHUNK = 4096
+    # In-RAM capacity starts here and doubles; most users never pass a few
+    # dozen turns, and every allocated row counts toward the state budget
+    INITIAL_ROWS = 4
+
+    def __init__(self, dim: int, max_rows: int, path: str = "") -> None:
+        self.dim = dim
+        self.max_rows = max_rows
+        # Compaction runs once count passes this; the slack keeps an index at
+        # max_rows from being rewritten on every append
+        self.row_limit = max_rows + max(16, max_rows // 4)
+        self.path = path
+        self.count = 0
+        # Rows appended since open or the last compaction
+        self.appended = 0
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.offsets = np.empty(0, dtype=np.int64)
+        self.mapped = 0
+        self.log: io.BufferedIOBase | None = None
+        self.writers: list[io.BufferedWriter] = []
+        if path:
+            self.open()
+        else:
+            self.log = io.BytesIO()
+
+    def capacity(self, rows: int) -> int:
+        return min(max(self.INITIAL_ROWS, rows), self.row_limit + 1)
+
+    def files(self, suffix: str = "") -> tuple[str, str, str]:
+        return tuple(f"{self.path}.{ext}{suffix}" for ext in ("vec", "idx", "log"))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(f"{path}.idx") or os.path.exists(f"{path}.idx.new.done")
+
+    def open(self) -> None:
+        self.recover()
+        vec_path, idx_path, log_path = self.files()
+        for path in (vec_path, idx_path, log_path):
+            open(path, "ab").close()
+        rows = min(
+            os.path.getsize(idx_path) // 8,
+            os.path.getsize(vec_path) // (4 * self.dim),
+        )
+        # Drop the tail of an append interrupted before its offset was written
+        os.truncate(vec_path, rows * 4 * self.dim)
+        os.truncate(idx_path, rows * 8)
+        self.writers = [open(path, "ab") for path in (vec_path, idx_path, log_path)]
+        self.log = open(log_path, "rb")
+        self.count = rows
+        self.remap()
+
+    def recover(self) -> None:
+        """Finish or roll back a compaction interrupted by a crash."""
+        new_files = self.files(".new")
+        done = f"{new_files[1]}.done"
+        if os.path.exists(done):
+            for new, current in zip(new_files, self.files()):
+                if os.path.exists(new):
+                    os.replace(new, current)
+            os.remove(done)
+        else:
+            for new in new_files:
+                if os.path.exists(new):
+                    os.remove(new)
+
+    def close(self) -> None:
+        for handle in (*self.writers, self.log):
+            if handle is not None:
+                handle.close()
+        self.writers = []
+        self.log = None
+        self.vectors = np.empty((0, self.dim), dtype=np.float32)
+        self.offsets = np.empty(0, dtype=np.int64)
+        self.mapped = 0
+
+    def remap(self) -> None:
+        if not self.path:
+            return
+        if self.count == 0:
+            self.vectors = np.empty((0, self.dim), dtype=np.float32)
+            self.offsets = np.empty(0, dtype=np.int64)
+        else:
+            vec_path, idx_path, _ = self.files()
+            self.vectors = np.memmap(
+                vec_path, dtype=np.float32, mode="r", shape=(self.count, self.dim)
+            )
+            self.offsets = np.memmap(idx_path, dtype=np.int64, mode="r", shape=(self.count,))
+        self.mapped = self.count
+
+    def append(self, vector: np.ndarray, entry: MemoryEntry) -> None:
+        line = (json.dumps(entry.to_dict()) + "\n").encode("utf-8")
+        vector = np.ascontiguousarray(vector, dtype=np.float32)
+        if self.path:
+            vec_file, idx_file, log_file = self.writers
+            offset = log_file.tell()
+            log_file.write(line)
+            log_file.flush()
+            vec_file.write(vector.tobytes())
+            vec_file.flush()
+            idx_file.write(np.int64(offset).tobytes())
+            idx_file.flush()
+        else:
+            self.log.seek(0, io.SEEK_END)
+            offset = self.log.tell()
+            self.log.write(line)
+            if self.count == len(self.offsets):
+                capacity = self.capacity(2 * self.count)
+                if capacity <= self.count:
+                    # Past the limit while a compaction is still in progress
+                    capacity = 2 * self.count
+                self.vectors = np.resize(self.vectors, (capacity, self.dim))
+                self.offsets = np.resize(self.offsets, capacity)
+            self.vectors[self.count] = vector
+            self.offsets[self.count] = offset
+        self.count += 1
+        self.appended += 1
+
+    def entry(self, row: int) -> MemoryEntry:
+        self.log.seek(int(self.offsets[row]))
+        return MemoryEntry.from_dict(json.loads(self.log.readline()))
+
+    def search(
+        self, query: np.ndarray, k: int, rows: int, min_score: float
+    ) -> list[tuple[float, MemoryEntry]]:
+        """Top ``k`` of the first ``rows`` rows by cosine similarity."""
+        if self.path and self.mapped != self.count:
+            self.remap()
+        rows = min(rows, self.count)
+        if rows <= 0 or k <= 0:
+            return []
+
+        scores = np.empty(rows, dtype=np.float32)
+        for start in range(0, rows, self.SEARCH_CHUNK):
+            end = min(rows, start + self.SEARCH_CHUNK)
+            np.dot(self.vectors[start:end], query, out=scores[start:end])
+
+        k = min(k, rows)
+        top = np.argpartition(scores, rows - k)[rows - k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(float(scores[row]), self.entry(row)) for row in top if scores[row] >= min_score]
+
+    @property
+    def nbytes(self) -> int:
+        """RAM held by an in-memory index; mapped files live in the page cache."""
+        if self.path:
+            return 0
+        with self.log.getbuffer() as view:
+            return self.vectors.nbytes + self.offsets.nbytes + view.nbytes
+
+    def needs_compaction(self) -> bool:
+        # Geometric triggers keep rewrites amortized O(1) per append
+        return self.count > self.row_limit or self.appended >= max(1024, self.count // 2)
+
+    def compaction(self) -> Generator[None, None, int]:
+        """Rewrite the newest ``max_rows`` distinct rows; returns rows dropped.
+
+        Repeated turns ("lol", "hi") embed to identical vectors and would
+        crowd out recall, so only the newest copy of each is kept. Each
+        ``next`` does at most COMPACT_CHUNK rows of work, so the caller can
+        run appends and searches in between; rows appended meanwhile are
+        carried over in the final step.
+        """
+        if self.path and self.mapped != self.count:
+            self.remap()
+        total = self.count
+        seen: set[int] = set()
+        keep: list[int] = []
+        for row in range(total - 1, -1, -1):
+            if (total - row) % self.COMPACT_CHUNK == 0:
+                yield
+            digest = hash(self.vectors[row].tobytes())
+            if digest in seen:
+                continue
+            seen.add(digest)
+            keep.append(row)
+            if len(keep) == self.max_rows:
+                break
+        keep.reverse()
+        dropped = total - len(keep)
+        if not dropped:
+            self.appended = self.count - total
+            return 0
+
+        # Stream the kept rows out in chunks; copying a large mapped matrix
+        # whole would pull it all into RAM
+        if self.path:
+            new_files = self.files(".new")
+            targets = [open(path, "wb") for path in new_files]
+        else:
+            targets = [io.BytesIO() for _ in range(3)]
+        complete = False
+        try:
+            offset = 0
+            for start in range(0, len(keep), self.COMPACT_CHUNK):
+                offset = self.copy_rows(keep[start : start + self.COMPACT_CHUNK], targets, offset)
+                yield
+
+            # Rows appended while compacting are newer than anything kept
+            if self.path and self.mapped != self.count:
+                self.remap()
+            tail = self.count - total
+            self.copy_rows(list(range(total, self.count)), targets, offset)
+            count = len(keep) + tail
+            if not self.path:
+                vec_out, idx_out, log_out = targets
+                # Keep the capacity the next appends need rather than regrowing
+                capacity = self.capacity(2 * count)
+                self.vectors = np.resize(
+                    np.frombuffer(vec_out.getvalue(), dtype=np.float32).reshape(-1, self.dim),
+                    (capacity, self.dim),
+                )
+                self.offsets = np.resize(
+                    np.frombuffer(idx_out.getvalue(), dtype=np.int64), capacity
+                )
+                self.log = log_out
+                self.count = count
+            else:
+                # The new generation sits beside the old one until marked
+                # complete; recover() (run by open) swaps it in, or discards
+                # it after a crash
+                for target in targets:
+                    target.close()
+                open(f"{new_files[1]}.done", "wb").close()
+                self.close()
+                self.open()
+            self.appended = tail
+            complete = True
+            return dropped
+        finally:
+            if not complete:
+                for target in targets:
+                    target.close()
+                if self.path:
+                    for path in new_files:
+                        if os.path.exists(path):
+                            os.remove(path)
+
+    def copy_rows(self, rows: list[int], targets: list, offset: int) -> int:
+        vec_out, idx_out, log_out = targets
+        vec_out.write(np.ascontiguousarray(self.vectors[rows]).tobytes())
+        for row in rows:
+            self.log.seek(int(self.offsets[row]))
+            line = self.log.readline()
+            idx_out.write(np.int64(offset).tobytes())
+            log_out.write(line)
+            offset += len(line)
+        return offset
+
+
+class LongTermMemory:
+    """Per-user and per-chat VectorIndexes behind one dedicated I/O thread.
+
+    Like SQLiteStorage, all index access runs on a single thread, so the
+    event loop never touches the disk and indexes need no locking. At most
+    ``max_open`` on-disk indexes stay open (each holds file descriptors);
+    in-memory ones have no backing store, so they stay until their user or
+    chat is evicted from the hot cache.
+    ``resident`` holds the RAM each open in-memory index uses, for the
+    StateManager budget.
+    """
+
+    def __init__(
+        self,
+        embedder: HashingEmbedder | APIEmbedder,
+        dim: int,
+        directory: str,
+        max_rows: int,
+        max_open: int,
+    ) -> None:
+        self.embedder = embedder
+        self.dim = dim
+        self.directory = directory
+        self.max_rows = max_rows
+        self.max_open = max_open
+        self.indexes: OrderedDict[tuple[str, int], VectorIndex] = OrderedDict()
+        self.resident: dict[tuple[str, int], int] = {}
+        self.compactions: dict[tuple[str, int], Generator[None, None, int]] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-index")
+
+    async def run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def index_path(self, kind: str, key: int) -> str:
+        return os.path.join(self.directory, f"{kind}-{key}") if self.directory else ""
+
+    def index(self, kind: str, key: int, create: bool = True) -> VectorIndex | None:
+        index = self.indexes.get((kind, key))
+        if index is not None:
+            self.indexes.move_to_end((kind, key))
+            return index
+        path = self.index_path(kind, key)
+        if not create and (not path or not VectorIndex.exists(path)):
+            return None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        index = self.indexes[(kind, key)] = VectorIndex(self.dim, self.max_rows, path)
+        while self.directory and len(self.indexes) > self.max_open:
+            self.release(*next(iter(self.indexes)))
+        return index
+
+    def append(self, kind: str, key: int, vector: np.ndarray, entry: MemoryEntry) -> bool:
+        """Append a row; returns whether the index now needs compacting."""
+        index = self.index(kind, key)
+        index.append(vector, entry)
+        if not self.directory:
+            self.resident[(kind, key)] = index.nbytes
+        return (kind, key) not in self.compactions and index.needs_compaction()
+
+    def compact_step(self, kind: str, key: int) -> bool:
+        """Advance the index's compaction by one step; True once it is over."""
+        index = self.indexes.get((kind, key))
+        steps = self.compactions.get((kind, key))
+        if steps is None:
+            if index is None or not index.needs_compaction():
+                return True
+            steps = self.compactions[(kind, key)] = index.compaction()
+        try:
+            next(steps)
+            return False
+        except StopIteration as done:
+            if done.value:
+                logger.info(f"🗜️ Compacted {kind} {key} memory index, dropped {done.value} rows")
+            if not self.directory:
+                self.resident[(kind, key)] = index.nbytes
+            return True
+        finally:
+            if steps.gi_frame is None:
+                self.compactions.pop((kind, key), None)
+
+    def resident_bytes(self, kind: str, key: int) -> int:
+        return self.resident.get((kind, key), 0)
+
+    def search(
+        self,
+        kind: str,
+        key: int,
+        query: np.ndarray,
+        k: int,
+        skip_newest: int,
+        min_score: float,
+    ) -> list[tuple[float, MemoryEntry]]:
+        index = self.index(kind, key, create=False)
+        if index is None:
+            return []
+        return index.search(query, k, index.count - skip_newest, min_score)
+
+    def release(self, kind: str, key: int) -> None:
+        """Close an index; on disk it reopens on next use, in RAM it is gone."""
+        steps = self.compactions.pop((kind, key), None)
+        if steps is not None:
+            steps.close()
+        index = self.indexes.pop((kind, key), None)
+        if index is not None:
+            index.close()
+        self.resident.pop((kind, key), None)
+
+    def delete(self, kind: str, key: int) -> None:
+        self.release(kind, key)
+        path = self.index_path(kind, key)
+        if path:
+            for suffix in ("vec", "idx", "log", "vec.new", "idx.new", "log.new", "idx.new.done"):
+                if os.path.exists(f"{path}.{suffix}"):
+                    os.remove(f"{path}.{suffix}")
+
+    async def remember(self, kind: str, key: int, entry: MemoryEntry) -> None:
+        try:
+            vector = (await self.embedder.embed([memory_text(entry)]))[0]
+            if await self.run(self.append, kind, key, vector, entry):
+                # One step per executor job, so appends and recalls for
+                # other users queue behind a step rather than the whole pass
+                while not await self.run(self.compact_step, kind, key):
+                    pass
+        except Exception as e:
+            logger.error(f"❌ Failed to index memory for {kind} {key}: {type(e).__name__}: {e}")
+
+    async def recall(
+        self,
+        query: np.ndarray,
+        sources: list[tuple[str, int, int]],
+        k: int,
+        min_score: float,
+    ) -> list[MemoryEntry]:
+        """The ``k`` best turns across ``sources`` of (kind, key, skip_newest).
+
+        ``skip_newest`` excludes the turns still in the memory window, which
+        the prompt carries anyway.
+        """
+        found: dict[tuple[float, str], tuple[float, MemoryEntry]] = {}
+        for kind, key, skip in sources:
+            for score, entry in await self.run(
+                self.search, kind, key, query, k, skip, min_score
+            ):
+                # A group turn is indexed for both the user and the chat
+                seen = found.get((entry.timestamp, entry.user_message))
+                if seen is None or seen[0] < score:
+                    found[(entry.timestamp, entry.user_message)] = (score, entry)
+        best = sorted(found.values(), key=lambda item: item[0], reverse=True)[:k]
+        return [entry for _, entry in best]
+
+    async def forget(self, kind: str, key: int) -> None:
+        await self.run(self.delete, kind, key)
+
+    async def evict(self, kind: str, key: int) -> None:
+        await self.run(self.release, kind, key)
+
+    async def close(self) -> None:
+        def close_all() -> None:
+            while self.indexes:
+                self.release(*next(iter(self.indexes)))
+
+        await self.run(close_all)
+        self.executor.shutdown(wait=True)
+
+
+def create_long_term_memory(client: AsyncOpenAI) -> LongTermMemory | None:
+    if not MEMORY_ENABLED:
+        return None
+    if MEMORY_EMBEDDER == "api":
+        embedder = APIEmbedder(client, MEMORY_EMBED_MODEL, MEMORY_EMBED_DIM)
+    else:
+        if MEMORY_EMBEDDER != "hash":
+            logger.warning(f"⚠️ Unknown MEMORY_EMBEDDER {MEMORY_EMBEDDER!r}, using hash")
+        embedder = HashingEmbedder(MEMORY_EMBED_DIM)
+    return LongTermMemory(
+        embedder,
+        MEMORY_EMBED_DIM,
+        MEMORY_INDEX_DIR,
+        MEMORY_MAX_ROWS if MEMORY_INDEX_DIR else min(MEMORY_MAX_ROWS, MEMORY_RAM_ROWS),
+        MEMORY_OPEN_INDEXES,
+    )
+
+
+# =========================
+# State Management
+# =========================
+
+
+def estimate_entry_size(entry: MemoryEntry) -> int:
+    """Approximate retained bytes of one memory entry.
+
+    Interned names/titles are shared, so only the messages are counted.
+    """
+    return (
+        sys.getsizeof(entry)
+        + sys.getsizeof(entry.user_message)
+        + sys.getsizeof(entry.bot_response)
+    )
+
+
+USER_INFO_SIZE = 400
+
+
+class StateManager:
+    """Keeps per-user and per-chat hot state within a memory budget.
+
+    Tracks when each ``(kind, key)`` was last touched (in LRU order) and an
+    approximate byte size. ``select_evictions`` returns keys idle for longer
+    than ``idle_ttl`` plus, while over budget, the least recently used keys
+    that have been idle for at least ``min_idle`` (so state a running handler
+    is still using is never dropped). The caller removes the actual data.
+    """
+
+    def __init__(self, budget_bytes: int, idle_ttl: float, min_idle: float) -> None:
+        self.budget_bytes = budget_bytes
+        self.idle_ttl = idle_ttl
+        self.min_idle = min_idle
+        self.last_seen: OrderedDict[tuple[str, int], float] = OrderedDict()
+        self.sizes: dict[tuple[str, int], int] = {}
+        self.total_bytes = 0
+        self.pinned: set[tuple[str, int]] = set()
+        self.evictions = 0
+        self.expirations = 0
+        self.started = time.monotonic()
+
+    def touch(self, kind: str, key: int) -> None:
+        self.last_seen[(kind, key)] = time.monotonic()
+        self.last_seen.move_to_end((kind, key))
+
+    def resize(self, kind: str, key: int, nbytes: int) -> None:
+        self.total_bytes += nbytes - self.sizes.get((kind, key), 0)
+        self.sizes[(kind, key)] = nbytes
+
+    def forget(self, kind: str, key: int) -> None:
+        self.last_seen.pop((kind, key), None)
+        self.total_bytes -= self.sizes.pop((kind, key), 0)
+
+    def select_evictions(self) -> list[tuple[str, int]]:
+        now = time.monotonic()
+        expired: list[tuple[str, int]] = []
+        evicted: list[tuple[str, int]] = []
+        projected = self.total_bytes
+
+        for state_key, seen in self.last_seen.items():
+            if state_key in self.pinned:
+                continue
+            idle = now - seen
+            if self.idle_ttl > 0 and idle > self.idle_ttl:
+                expired.append(state_key)
+            elif projected > self.budget_bytes and idle >= self.min_idle:
+                evicted.append(state_key)
+            else:
+                # LRU order: everything after this is even more recent
+                break
+            projected -= self.sizes.get(state_key, 0)
+
+        self.expirations += len(expired)
+        self.evictions += len(evicted)
+        return expired + evicted
+
+    def stats(self) -> dict:
+        hours = max((time.monotonic() - self.started) / 3600, 1e-9)
+        return {
+            "tracked": len(self.last_seen),
+            "bytes": self.total_bytes,
+            "budget_bytes": self.budget_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "evictions_per_hour": round((self.evictions + self.expirations) / hours, 2),
+        }
+
+
+# =========================
+# Image Pipeline
+# =========================
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable read-only file over a buffer, so PIL can decode without a copy.
+
+    io.BytesIO copies anything that is not ``bytes``; this wraps the
+    downloaded bytearray (or a memoryview of it) in place.
+    """
+
+    def __init__(self, data) -> None:
+        self.view = memoryview(data).cast("B")
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+
+def base64_size(n: int) -> int:
+    return 4 * ((n + 2) // 3)
+
+
+def resolve_image_format(image_format: str) -> str:
+    if image_format == "webp":
+        from PIL import features
+
+        if features.check("webp"):
+            return "WEBP"
+        logger.warning("⚠️ Pillow built without WebP, encoding JPEG instead")
+    return "JPEG"
+
+
+def encode_to_budget(
+    image: Image.Image,
+    image_format: str,
+    byte_budget: int,
+    min_quality: int,
+    max_quality: int,
+) -> io.BytesIO | None:
+    """Return the highest-quality encoding whose base64 size fits byte_budget.
+
+    Tries max_quality first (the common case for small photos), then bisects
+    the quality range. Two buffers are reused so the winning encoding never
+    has to be redone. Returns None if even min_quality is over budget.
+    """
+    best = io.BytesIO()
+    scratch = io.BytesIO()
+
+    def encode(quality: int, buffer: io.BytesIO) -> int:
+        buffer.seek(0)
+        buffer.truncate()
+        image.save(buffer, format=image_format, quality=quality)
+        return base64_size(buffer.tell())
+
+    if encode(max_quality, best) <= byte_budget:
+        return best
+
+    found = False
+    lo, hi = min_quality, max_quality - 1
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        if encode(quality, scratch) <= byte_budget:
+            best, scratch = scratch, best
+            found = True
+            lo = quality + 1
+        else:
+            hi = quality - 1
+
+    return best if found else None
+
+
+# Modes whose pixels Image.reduce can box-average
+REDUCE_MODES = frozenset({"L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "I", "F"})
+
+
+def encode_image(
+    image_data,
+    max_size: int,
+    byte_budget: int,
+    image_format: str = "jpeg",
+    min_quality: int = 40,
+    max_quality: int = 85,
+) -> tuple[str, dict[str, float]]:
+    """Decode, downscale and re-encode an image as a base64 data URL.
+
+    The result fits in byte_budget; if no quality setting does, the image is
+    shrunk further. Runs inside a pool worker, so it must stay a picklable
+    module-level function. Also returns the seconds spent per stage.
+    """
+    started = time.perf_counter()
+    image = Image.open(BufferReader(image_data))
+
+    oversized = image.width > max_size or image.height > max_size
+    if oversized:
+        if image.format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale (never below
+            # max_size) and do the YCbCr -> RGB conversion itself
+            image.draft("RGB", (max_size, max_size))
+        else:
+            factor = min(image.width, image.height) // max_size
+            if factor >= 2:
+                if image.mode not in REDUCE_MODES:
+                    # reduce() rejects 1, P and I;16 and would average palette
+                    # indices; the result becomes RGB below anyway
+                    transparent = "transparency" in image.info or image.mode == "PA"
+                    image = image.convert("RGBA" if transparent else "RGB")
+                image = image.reduce(factor)
+    image.load()
+    decoded = time.perf_counter()
+
+    if oversized:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    resized = time.perf_counter()
+
+    pil_format = resolve_image_format(image_format)
+    while True:
+        buffer = encode_to_budget(
+            image, pil_format, byte_budget, min_quality, max_quality
+        )
+        if buffer is not None or max(image.size) <= 256:
+            break
+        image.thumbnail(
+            (int(image.width * 0.75), int(image.height * 0.75)),
+            Image.Resampling.LANCZOS,
+        )
+
+    if buffer is None:
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, quality=min_quality)
+
+    # getbuffer() exposes the encoded bytes without copying them out
+    payload = base64.b64encode(buffer.getbuffer()).decode("ascii")
+    timings = {
+        "decode": decoded - started,
+        "resize": resized - decoded,
+        "encode": time.perf_counter() - resized,
+    }
+    return f"data:image/{pil_format.lower()};base64,{payload}", timings
+
+
+def make_warm_up_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def warm_up_image_worker() -> int:
+    """Pay PIL import and JPEG codec setup once per worker, not on the first photo."""
+    encode_image(make_warm_up_image(), 16, 10_000)
+    return os.getpid()
+
+
+def select_photo_size(photos: Sequence[PhotoSize], target: int) -> PhotoSize:
+    """Pick the smallest Telegram photo variant whose longer side covers target.
+
+    Falls back to the largest variant when none is big enough, so we never
+    download more bytes than the resize step would keep.
+    """
+    ordered = sorted(photos, key=lambda p: (max(p.width, p.height), p.file_size or 0))
+    for photo in ordered:
+        if max(photo.width, photo.height) >= target:
+            return photo
+    return ordered[-1]
+
+
+class ImagePipelineBusy(Exception):
+    pass
+
+
+class ImagePipeline:
+    """Runs CPU-bound image work in a process pool, off the event loop.
+
+    At most ``workers + queue_size`` jobs are admitted at once; further
+    callers wait for a slot (backpressure) and give up after ``timeout``.
+    Jobs that exceed ``timeout`` are reported as failures: a queued job is
+    cancelled, but one already running cannot be, so it keeps its slot
+    until the worker is actually free again. A worker that dies (crash, OOM
+    kill) breaks the whole pool; it is replaced and the job retried once.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float) -> None:
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(max(1, workers) + max(0, queue_size))
+        self.executor: Executor | None = None
+
+    def new_executor(self) -> Executor:
+        if self.workers <= 0:
+            return ThreadPoolExecutor(thread_name_prefix="image")
+        # spawn, not fork: forking a process that already runs an event loop
+        # and HTTP client threads is unsafe
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    async def start(self) -> None:
+        self.executor = self.new_executor()
+        if self.workers <= 0:
+            logger.info("🖼️ Image pipeline using a thread pool")
+            return
+
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(
+            *(
+                loop.run_in_executor(self.executor, warm_up_image_worker)
+                for _ in range(self.workers)
+            )
+        )
+        logger.info(f"🖼️ Image pipeline warmed up {len(set(pids))} worker(s)")
+
+    async def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def restart(self, broken: Executor) -> None:
+        # Every job on a broken pool fails with it; only the first replaces it,
+        # and none does after shutdown
+        if self.executor is not broken:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.new_executor()
+        logger.warning("🖼️ Image worker died, restarted the pool")
+
+    async def run(self, func: Callable, *args):
+        try:
+            return await self.attempt(func, *args)
+        except BrokenProcessPool:
+            return await self.attempt(func, *args)
+
+    async def attempt(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise ImagePipelineBusy("image pipeline queue is full") from None
+
+        executor = self.executor
+        try:
+            job = executor.submit(func, *args)
+        except BaseException as e:
+            self.slots.release()
+            if isinstance(e, BrokenProcessPool):
+                self.restart(executor)
+            raise
+        job.add_done_callback(lambda _: self.job_done(loop))
+
+        remaining = max(0.1, self.timeout - (loop.time() - started))
+        try:
+            # wait_for cancels the pool future on timeout, so queued jobs never run
+            return await asyncio.wait_for(asyncio.wrap_future(job), remaining)
+        except BrokenProcessPool:
+            self.restart(executor)
+            raise
+
+    def job_done(self, loop: asyncio.AbstractEventLoop) -> None:
+        # Runs on the pool's thread once the job finished or was cancelled
+        try:
+            loop.call_soon_threadsafe(self.slots.release)
+        except RuntimeError:
+            pass  # loop already closed during shutdown
+
+
+# =========================
+# Rate Limiting
+# =========================
+
+
+class TokenBucket:
+    """Token bucket refilled at ``rate`` tokens/s, holding at most ``burst``.
+
+    ``reserve`` takes tokens immediately, letting the balance go negative,
+    and returns how long the caller must wait. Waiters are therefore served
+    in arrival order without a lock. ``pause`` blocks the bucket entirely,
+    e.g. for a server-sent retry_after. A ``rate`` of 0 means unlimited:
+    only ``pause`` holds such a bucket back.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        now = time.monotonic()
+        if self.rate <= 0:
+            return max(0.0, self.blocked_until - now)
+        self.refill(now)
+        self.tokens -= tokens
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def ready(self, tokens: float = 1.0) -> bool:
+        """Whether ``tokens`` could be taken right now without waiting."""
+        now = time.monotonic()
+        if self.rate <= 0:
+            return now >= self.blocked_until
+        self.refill(now)
+        return self.tokens >= tokens and now >= self.blocked_until
+
+    async def acquire(self, tokens: float = 1.0) -> float:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self.refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+
+class KeyedTokenBuckets:
+    """Lazily created bucket per key; full, idle buckets are pruned."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 1024) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: dict[Hashable, TokenBucket] = {}
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                for idle_key in [k for k, b in self.buckets.items() if b.is_idle()]:
+                    del self.buckets[idle_key]
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+
+class RateLimitStats:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.retry_afters = 0
+        self.skipped = 0
+
+    def record(self, waited: float) -> None:
+        self.requests += 1
+        if waited > 0:
+            self.throttled += 1
+            self.wait_seconds += waited
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "wait_seconds": round(self.wait_seconds, 2),
+            "retry_afters": self.retry_afters,
+            "skipped": self.skipped,
+        }
+
+
+def retry_after_seconds(error: Exception, default: float = 1.0) -> float:
+    response = getattr(error, "response", None)
+    header = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(header) if header else default
+    except ValueError:
+        return default
+
+
+# Set by background work (summaries) so its model calls use the background bucket
+background_call: ContextVar[bool] = ContextVar("background_call", default=False)
+
+
+class ModelRateLimiter:
+    """Global plus per-model token buckets for the upstream model API.
+
+    Calls made under ``background_call`` draw from their own bucket instead,
+    so upkeep never spends tokens replies need; they still honor a model's
+    retry-after pause.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        model_rate: float,
+        model_burst: float,
+        background_rate: float,
+        background_burst: float,
+    ):
+        self.global_bucket = TokenBucket(rate, burst)
+        self.model_buckets = KeyedTokenBuckets(model_rate, model_burst)
+        self.background_bucket = TokenBucket(background_rate, background_burst)
+        self.stats = RateLimitStats()
+
+    async def acquire(self, model: str) -> None:
+        model_bucket = self.model_buckets.get(model)
+        if background_call.get():
+            wait = max(
+                self.background_bucket.reserve(),
+                model_bucket.blocked_until - time.monotonic(),
+            )
+        else:
+            # Reserve on both buckets up front and sleep once for the longer wait
+            wait = max(self.global_bucket.reserve(), model_bucket.reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.stats.record(wait)
+
+    def pause(self, model: str, seconds: float) -> None:
+        """Honor a 429 retry-after: hold back every call to this model."""
+        self.stats.retry_afters += 1
+        self.model_buckets.get(model).pause(seconds)
+        logger.warning(f"⏳ {model} rate limited, pausing for {seconds:.1f}s")
+
+
+def split_message(text: str) -> list[str]:
+    """Split text into chunks that fit in one Telegram message."""
+    return [
+        text[i : i + TELEGRAM_MAX_MESSAGE_LENGTH]
+        for i in range(0, len(text), TELEGRAM_MAX_MESSAGE_LENGTH)
+    ]
+
+
+# rate_limit_args for requests that are worth sending only if no wait is
+# needed, such as streaming preview edits
+BEST_EFFORT = "best-effort"
+
+
+class RateLimited(Exception):
+    """A BEST_EFFORT request was dropped because it would have had to wait."""
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Token-bucket limiter for outbound Bot API calls.
+
+    Every chat-bound request takes a token from the global bucket and from
+    its chat's bucket (negative chat ids use the slower group bucket).
+    On RetryAfter all requests pause for the advised time and the request is
+    retried up to ``max_retries`` times; pass ``rate_limit_args=0`` to get the
+    RetryAfter back immediately instead. ``rate_limit_args=BEST_EFFORT``
+    raises RateLimited rather than waiting for a token, and never retries.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        chat_rate: float,
+        chat_burst: float,
+        group_rate: float,
+        group_burst: float,
+        max_retries: int,
+    ) -> None:
+        self.global_bucket = TokenBucket(rate, rate)
+        self.chat_buckets = KeyedTokenBuckets(chat_rate, chat_burst)
+        self.group_buckets = KeyedTokenBuckets(group_rate, group_burst)
+        self.max_retries = max_retries
+        self.stats = RateLimitStats()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def chat_bucket(self, chat_id: object) -> TokenBucket | None:
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            # @channelusername style ids are always channels/supergroups
+            return self.group_buckets.get(chat_id) if chat_id else None
+        if chat_id < 0:
+            return self.group_buckets.get(chat_id)
+        return self.chat_buckets.get(chat_id)
+
+    def ready(self, chat_id: object) -> bool:
+        """Whether a message to ``chat_id`` could be sent without waiting."""
+        chat_bucket = self.chat_bucket(chat_id)
+        return chat_bucket is None or (self.global_bucket.ready() and chat_bucket.ready())
+
+    async def process_request(
+        self,
+        callback,
+        args,
+        kwargs,
+        endpoint,
+        data,
+        rate_limit_args,
+    ):
+        chat_bucket = self.chat_bucket(data.get("chat_id"))
+        if rate_limit_args == BEST_EFFORT:
+            if chat_bucket is not None:
+                if not self.ready(data.get("chat_id")):
+                    self.stats.skipped += 1
+                    raise RateLimited(endpoint)
+                self.global_bucket.reserve()
+                chat_bucket.reserve()
+                self.stats.record(0.0)
+            return await callback(*args, **kwargs)
+
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        for attempt in range(max_retries + 1):
+            if chat_bucket is not None:
+                wait = max(self.global_bucket.reserve(), chat_bucket.reserve())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self.stats.record(wait)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.stats.retry_afters += 1
+                retry_after = float(e.retry_after) + 0.1
+                self.global_bucket.pause(retry_after)
+                if attempt == max_retries:
+                    raise
+                logger.warning(f"⏳ Telegram flood wait on {endpoint}, retrying in {retry_after:.1f}s")
+                await asyncio.sleep(retry_after)
+
+
+# =========================
+# Metrics
+# =========================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    """One metric family in the Prometheus text format, keyed by label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        for key, value in self.values.items():
+            yield self.name, self.labels, key, value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f"{name}{format_labels(label_names, label_values)} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """A settable gauge, or one computed at scrape time by ``collect``."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        collect: Callable[[], dict[tuple[str, ...], float]] | None = None,
+    ) -> None:
+        super().__init__(name, help_text, labels)
+        self.collect = collect
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[str, ...] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (+Inf last)], sum
+        self.series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self):
+        label_names = self.labels + ("le",)
+        for key, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield f"{self.name}_bucket", label_names, key + (le,), cumulative
+            yield f"{self.name}_sum", self.labels, key, total[0]
+            yield f"{self.name}_count", self.labels, key, cumulative
+
+
+class BotMetrics:
+    """Registry of everything exported on /metrics."""
+
+    def __init__(self) -> None:
+        self.handler_seconds = Histogram(
+            "darkbot_handler_seconds", "Time spent in update handlers", ("handler",)
+        )
+        self.handler_errors = Counter(
+            "darkbot_handler_errors_total", "Handler invocations that raised", ("handler",)
+        )
+        self.handlers_in_flight = Gauge(
+            "darkbot_handlers_in_flight", "Handler invocations in progress", ("handler",)
+        )
+        self.llm_seconds = Histogram(
+            "darkbot_llm_request_seconds", "Model API call latency", ("model", "stream")
+        )
+        self.llm_errors = Counter(
+            "darkbot_llm_errors_total", "Failed model API calls", ("model", "error")
+        )
+        self.span_seconds = Histogram(
+            "darkbot_span_seconds", "Handler stage timings", ("handler", "span")
+        )
+        self.prompt_tokens = Histogram(
+            "darkbot_prompt_tokens",
+            "Estimated prompt size after context assembly",
+            buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000),
+        )
+        self.summaries = Counter(
+            "darkbot_summaries_total",
+            "Memory windows folded into a rolling summary",
+            ("kind", "outcome"),
+        )
+        self.image_seconds = Histogram(
+            "darkbot_image_stage_seconds",
+            "Image pipeline stage timings",
+            ("stage",),
+        )
+        self.families: list[Metric] = [
+            self.handler_seconds,
+            self.handler_errors,
+            self.handlers_in_flight,
+            self.llm_seconds,
+            self.llm_errors,
+            self.span_seconds,
+            self.prompt_tokens,
+            self.summaries,
+            self.image_seconds,
+        ]
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], float]) -> None:
+        """Register an unlabelled gauge computed at scrape time."""
+        self.families.append(Gauge(name, help_text, collect=lambda: {(): collect()}))
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for family in self.families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+# =========================
+# Tracing
+# =========================
+
+
+class Trace:
+    """Stage timings for one handler invocation."""
+
+    __slots__ = ("name", "started", "spans", "attrs")
+
+    def __init__(self, name: str, **attrs: Any) -> None:
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: list[tuple[str, float]] = []
+        self.attrs = attrs
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def record(self, total: float) -> dict[str, Any]:
+        spans: dict[str, float] = {}
+        for name, seconds in self.spans:
+            spans[name] = spans.get(name, 0.0) + seconds * 1000
+        return {
+            "event": "slow_update",
+            "handler": self.name,
+            "total_ms": round(total * 1000, 1),
+            "spans_ms": {name: round(ms, 1) for name, ms in spans.items()},
+            **self.attrs,
+        }
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """Time a stage of the current handler; a no-op outside a trace."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, time.perf_counter() - started))
+
+
+def add_span(name: str, seconds: float) -> None:
+    """Attach a stage timed elsewhere (e.g. in a pool worker)."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.spans.append((name, seconds))
+
+
+class SamplingProfiler:
+    """Profiles a random sample of handler runs with cProfile.
+
+    Only one profile runs at a time. It sees everything the event loop does
+    while the sampled handler is in flight, not just that handler.
+    """
+
+    def __init__(self, rate: float, directory: str) -> None:
+        self.rate = rate
+        self.directory = directory
+        self.active = False
+        self.dumped = 0
+        self.last_path = ""
+
+    def start(self) -> cProfile.Profile | None:
+        if self.rate <= 0 or self.active or random.random() >= self.rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (or tool) already owns the hook
+            return None
+        self.active = True
+        return profile
+
+    def stop(self, profile: cProfile.Profile, name: str) -> None:
+        profile.disable()
+        self.active = False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory,
+                f"{datetime.now():%Y%m%d-%H%M%S}-{name}-{self.dumped}.pstats",
+            )
+            profile.dump_stats(path)
+        except OSError as e:
+            logger.error(f"Failed to write profile: {e}")
+            return
+        self.dumped += 1
+        self.last_path = path
+        logger.info(f"🔬 Profile written to {path}")
+
+
+# =========================
+# Resilience
+# =========================
+
+
+class LatencyTracker:
+    """Sliding window of recent call latencies per model."""
+
+    def __init__(self, window: int = 200) -> None:
+        self.window = window
+        self.samples: dict[str, deque[float]] = {}
+
+    def record(self, model: str, seconds: float) -> None:
+        samples = self.samples.get(model)
+        if samples is None:
+            samples = self.samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model: str, pct: float, min_samples: int = 1) -> float | None:
+        samples = self.samples.get(model)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures, fails fast while open,
+    and lets a single trial call through once ``cooldown`` has passed."""
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def release(self) -> None:
+        """Called when a call ends without a verdict (cancelled, bad request)."""
+        self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                logger.warning(f"🔌 Circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+RETRYABLE_ERRORS = (
+    APITimeoutError,
+    APIConnectionError,
+    RateLimitError,
+    InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2**attempt))
+
+
+# =========================
+# Model Routing
+# =========================
+
+
+@dataclass(frozen=True, slots=True)
+class Route:
+    """Model and generation limits for one kind of request."""
+
+    model: str
+    max_tokens: int | None = None
+    temperature: float | None = None
+    fast_model: str = LLM_FAST_MODEL
+
+    def request_args(self) -> dict[str, Any]:
+        args: dict[str, Any] = {}
+        if self.max_tokens is not None:
+            args["max_tokens"] = self.max_tokens
+        if self.temperature is not None:
+            args["temperature"] = self.temperature
+        return args
+
+
+# Keyed by request kind; "owner:<kind>" entries take precedence for the owner
+DEFAULT_ROUTES = {
+    "casual": Route(DEFAULT_MODEL, max_tokens=120, temperature=0.9),
+    "default": Route(DEFAULT_MODEL, max_tokens=350, temperature=0.8),
+    "detail": Route(DEFAULT_MODEL, max_tokens=1500, temperature=0.7),
+    "image": Route(DEFAULT_MODEL, max_tokens=400, temperature=0.7),
+    "owner:detail": Route(DEFAULT_MODEL, max_tokens=2500, temperature=0.7),
+    "summary": Route(SUMMARY_MODEL, max_tokens=200, temperature=0.3, fast_model=""),
+}
+
+
+class ModelRouter:
+    """Maps a request kind to a Route and degrades it under pressure.
+
+    A route falls back to its fast_model while the primary model's observed
+    p95 latency is over ROUTE_LATENCY_SLO or the LLM concurrency limit is
+    nearly exhausted.
+    """
+
+    def __init__(self, routes: dict[str, Route], latency: LatencyTracker) -> None:
+        self.routes = routes
+        self.latency = latency
+        self.degraded = 0
+
+    @classmethod
+    def from_config(cls, latency: LatencyTracker, path: str = "") -> "ModelRouter":
+        routes = dict(DEFAULT_ROUTES)
+        if path:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    overrides = json.load(f)
+                for kind, fields in overrides.items():
+                    base = routes.get(kind) or routes.get(kind.removeprefix("owner:"))
+                    routes[kind] = replace(base or Route(DEFAULT_MODEL), **fields)
+                logger.info(f"🧭 Loaded route overrides from {path}")
+            except (OSError, ValueError, TypeError) as e:
+                logger.error(f"Failed to load routes from {path}: {e}")
+        return cls(routes, latency)
+
+    def route(self, kind: str, is_owner: bool = False) -> Route:
+        if is_owner and f"owner:{kind}" in self.routes:
+            return self.routes[f"owner:{kind}"]
+        return self.routes.get(kind) or self.routes["default"]
+
+    def select(self, route: Route, load: float) -> Route:
+        if not route.fast_model or route.fast_model == route.model:
+            return route
+        p95 = self.latency.percentile(route.model, 95, ROUTE_MIN_SAMPLES)
+        slow = p95 is not None and p95 > ROUTE_LATENCY_SLO
+        if not slow and load < ROUTE_LOAD_THRESHOLD:
+            return route
+        self.degraded += 1
+        reason = f"p95 {p95:.1f}s" if slow else f"load {load:.0%}"
+        logger.info(f"🧭 Routing to {route.fast_model} ({reason})")
+        return replace(route, model=route.fast_model)
+
+
+# =========================
+# Burst Coalescing
+# =========================
+
+
+class MessageBurst:
+    __slots__ = ("texts", "update", "context", "started_at", "last_at", "full")
+
+    def __init__(self, update: Update, context, now: float) -> None:
+        self.texts: list[str] = []
+        self.update = update
+        self.context = context
+        self.started_at = now
+        self.last_at = now
+        self.full = asyncio.Event()
+
+
+class MessageCoalescer:
+    """Debounces rapid consecutive messages per (chat, user) into one.
+
+    The first message of a burst starts a background timer and the handler
+    returns at once, so the chat's update queue keeps draining and follow-up
+    messages can join. The burst is answered, as one merged message, once
+    the user has been quiet for ``window`` seconds, ``max_wait`` seconds
+    after the first message, or once ``max_messages`` have arrived.
+
+    Answers go through ``schedule(chat_id, coroutine)`` (the update
+    scheduler's chat FIFO, so UPDATE_CONCURRENCY and per-chat ordering
+    apply), and each burst waits for the previous burst of the same
+    (chat, user) to be answered first, so replies never overtake.
+    """
+
+    def __init__(
+        self,
+        window: float,
+        max_wait: float,
+        max_messages: int,
+        start_task: Callable,
+        schedule: Callable,
+    ) -> None:
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.max_messages = max(1, max_messages)
+        self.start_task = start_task
+        self.schedule = schedule
+        self.bursts: dict[tuple[int, int], MessageBurst] = {}
+        # Latest burst task per key, answered or not
+        self.tails: dict[tuple[int, int], asyncio.Task] = {}
+        self.merged = 0
+
+    def enabled_for(self, chat_type: str) -> bool:
+        if self.window <= 0:
+            return False
+        return chat_type == "private" or COALESCE_GROUPS
+
+    def submit(
+        self,
+        key: tuple[int, int],
+        text: str,
+        update: Update,
+        context,
+        answer: Callable,
+    ) -> None:
+        now = asyncio.get_running_loop().time()
+        burst = self.bursts.get(key)
+        if burst is None or burst.full.is_set():
+            burst = self.bursts[key] = MessageBurst(update, context, now)
+            previous = self.tails.get(key)
+            self.tails[key] = self.start_task(self.run(key, burst, answer, previous))
+        else:
+            # Reply to the latest message of the burst
+            burst.update = update
+            burst.context = context
+            burst.last_at = now
+            self.merged += 1
+
+        burst.texts.append(text)
+        if len(burst.texts) >= self.max_messages:
+            burst.full.set()
+
+    async def run(
+        self,
+        key: tuple[int, int],
+        burst: MessageBurst,
+        answer: Callable,
+        previous: asyncio.Task | None,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        while not burst.full.is_set():
+            deadline = min(burst.last_at + self.window, burst.started_at + self.max_wait)
+            delay = deadline - loop.time()
+            if delay <= 0:
+                break
+            try:
+                await asyncio.wait_for(burst.full.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+        if self.bursts.get(key) is burst:
+            del self.bursts[key]
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.schedule(
+                key[0],
+                answer(burst.update, burst.context, "\n".join(burst.texts)),
+            )
+        except Exception as e:
+            logger.error(f"❌ Failed to answer coalesced messages: {e}")
+        finally:
+            if self.tails.get(key) is asyncio.current_task():
+                del self.tails[key]
+
+
+# =========================
+# Update Scheduling
+# =========================
+
+
+class FairUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates in order within a chat and concurrently across chats.
+
+    Each chat has its own FIFO. A chat with pending work sits in a shared
+    ready queue until one of ``workers`` worker tasks picks it up, runs
+    exactly one of its updates, and then re-queues it at the back. The
+    round-robin keeps one busy group from starving other chats. At most one
+    update per chat runs at a time, so per-chat ordering holds.
+    The base class semaphore bounds admitted (queued + running) updates.
+    """
+
+    def __init__(self, workers: int, max_queued: int) -> None:
+        super().__init__(max(workers, max_queued))
+        self.workers = max(1, workers)
+        self.queues: dict[Hashable, deque] = {}
+        self.ready: asyncio.Queue | None = None
+        self.worker_tasks: list[asyncio.Task] = []
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @staticmethod
+    def chat_key(update: object) -> Hashable:
+        chat = getattr(update, "effective_chat", None)
+        return chat.id if chat is not None else None
+
+    async def initialize(self) -> None:
+        self.ready = asyncio.Queue()
+        self.worker_tasks = [
+            asyncio.create_task(self.worker()) for _ in range(self.workers)
+        ]
+
+    async def shutdown(self) -> None:
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await self.submit(self.chat_key(update), coroutine)
+
+    async def submit(self, key: Hashable, coroutine) -> None:
+        """Run ``coroutine`` in chat ``key``'s FIFO and wait for it.
+
+        Also used for work that is deferred out of an update's handler
+        (coalesced answers), so it stays ordered and bounded like updates.
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            # A chat is only added to the ready queue when it has no queue yet,
+            # i.e. it is neither waiting nor running
+            self.ready.put_nowait(key)
+        queue.append((coroutine, done, loop.time()))
+        self.pending += 1
+        self.max_depth = max(self.max_depth, len(queue))
+
+        await done
+
+    async def worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            key = await self.ready.get()
+            queue = self.queues[key]
+            coroutine, done, enqueued_at = queue.popleft()
+
+            waited = loop.time() - enqueued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.pending -= 1
+            self.running += 1
+            try:
+                await coroutine
+                if not done.done():
+                    done.set_result(None)
+            except asyncio.CancelledError:
+                done.cancel()
+                raise
+            except Exception as e:
+                if not done.done():
+                    done.set_exception(e)
+            finally:
+                self.running -= 1
+                self.processed += 1
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.queues[key]
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.pending,
+            "running": self.running,
+            "chats_waiting": len(self.queues),
+            "max_chat_depth": self.max_depth,
+            "processed": self.processed,
+            "avg_wait_ms": round(1000 * self.wait_total / self.processed, 1)
+            if self.processed
+            else 0.0,
+            "max_wait_ms": round(1000 * self.wait_max, 1),
+        }
 
 
 # =========================
@@ -59,29 +3134,341 @@ class DarkBot:
         self.telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
         self.a4f_api_key = os.getenv("A4F_API_KEY")
 
-        if not self.telegram_token or not self.a4f_api_key:
-            logger.error("❌ Missing required environment variables.")
-            raise ValueError("TELEGRAM_BOT_TOKEN and A4F_API_KEY are required")
+        if not self.telegram_token or not self.a4f_api_key:
+            logger.error("❌ Missing required environment variables.")
+            raise ValueError("TELEGRAM_BOT_TOKEN and A4F_API_KEY are required")
+
+        self.webhook_secret = (
+            WEBHOOK_SECRET or hashlib.sha256(self.telegram_token.encode()).hexdigest()
+        )
+
+        # Retries are handled by resilient_completion, not the SDK
+        self.client = AsyncOpenAI(
+            api_key=self.a4f_api_key,
+            base_url=LLM_BASE_URL,
+            http_client=self.build_http_client(),
+            max_retries=0,
+        )
+        # Bounds in-flight completions; the pooled client does the I/O on the loop
+        self.llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        self.model_limiter = ModelRateLimiter(
+            LLM_RATE,
+            LLM_RATE_BURST,
+            LLM_MODEL_RATE,
+            LLM_MODEL_RATE_BURST,
+            LLM_BACKGROUND_RATE,
+            LLM_BACKGROUND_BURST,
+        )
+        self.metrics = BotMetrics()
+        self.profiler = SamplingProfiler(PROFILE_SAMPLE_RATE, PROFILE_DIR)
+        self.latency = LatencyTracker()
+        self.router = ModelRouter.from_config(self.latency, ROUTES_FILE)
+        self.llm_in_flight = 0
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.telegram_limiter = TelegramRateLimiter(
+            TELEGRAM_RATE,
+            TELEGRAM_CHAT_RATE,
+            TELEGRAM_CHAT_BURST,
+            TELEGRAM_GROUP_RATE,
+            TELEGRAM_GROUP_BURST,
+            TELEGRAM_MAX_RETRIES,
+        )
+
+        self.image_pipeline = ImagePipeline(
+            IMAGE_WORKERS,
+            IMAGE_QUEUE_SIZE,
+            IMAGE_TIMEOUT,
+        )
+        self.vision_cache = VisionCache(
+            VISION_CACHE_SIZE,
+            VISION_CACHE_TTL,
+            cache_analysis=VISION_CACHE_ANALYSIS,
+            path=VISION_CACHE_PATH,
+        )
+        self.response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+        self.response_flight = SingleFlight()
+        self.background_tasks: set[asyncio.Task] = set()
+        self.coalescer = MessageCoalescer(
+            COALESCE_WINDOW_MS / 1000,
+            COALESCE_MAX_WAIT_MS / 1000,
+            COALESCE_MAX_MESSAGES,
+            self.start_background_task,
+            self.run_in_chat,
+        )
+
+        # In‑memory state (hot cache in front of the storage backend)
+        self.user_memory: dict[int, deque[MemoryEntry]] = {}
+        self.group_memory: dict[int, deque[MemoryEntry]] = {}
+        self.users_interacted: dict[int, dict] = {}
+        # Prompt-ready history per user (message pairs) and chat (lines), built
+        # on first read
+        self.user_context: dict[int, ContextWindow] = {}
+        self.group_context: dict[int, ContextWindow] = {}
+        # Rolling summaries keyed like the state manager: ("user" | "chat", id)
+        self.summaries: dict[tuple[str, int], RollingSummary] = {}
+        self.summary_queue: asyncio.Queue[tuple[str, int]] = asyncio.Queue()
+        self.summary_pending: set[tuple[str, int]] = set()
+        self.storage = create_storage()
+        self.long_term = create_long_term_memory(self.client)
+        self.state_loads = SingleFlight()
+        self.state = StateManager(
+            int(STATE_MEMORY_BUDGET_MB * 1024 * 1024),
+            STATE_IDLE_TTL,
+            STATE_MIN_IDLE,
+        )
+
+        self.classifier = KeywordClassifier.from_config(KEYWORDS_FILE)
+        self.update_processor = FairUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_QUEUE_LIMIT)
+
+        # Owner info
+        self.owner_username = "gothicbatman"
+        self.owner_user_id: int | None = None
+
+        self.answer = self.instrumented(self.answer_message)
+        self.register_gauges()
+
+        logger.info("✅ Dark Bot (Multimodal) initialized successfully")
+
+    def register_gauges(self) -> None:
+        gauge = self.metrics.gauge
+        gauge("darkbot_users_in_memory", "Users in user_memory", lambda: len(self.user_memory))
+        gauge("darkbot_chats_in_memory", "Chats in group_memory", lambda: len(self.group_memory))
+        gauge("darkbot_state_bytes", "Approximate hot state size", lambda: self.state.total_bytes)
+        gauge("darkbot_llm_in_flight", "Model API calls in progress", lambda: self.llm_in_flight)
+        gauge(
+            "darkbot_updates_running",
+            "Updates being handled",
+            lambda: self.update_processor.running,
+        )
+        gauge(
+            "darkbot_updates_queued",
+            "Updates admitted and waiting",
+            lambda: self.update_processor.pending,
+        )
+
+    def instrumented(self, handler: Callable) -> Callable:
+        """Wrap a handler to trace it and record latency, errors and in-flight count.
+
+        Stages inside the handler are timed with span(); runs slower than
+        SLOW_REQUEST_MS are logged with their stage breakdown.
+        """
+        name = handler.__name__
+        metrics = self.metrics
+
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+            trace = Trace(
+                name,
+                update_id=update.update_id,
+                chat_id=update.effective_chat.id if update.effective_chat else None,
+                user_id=update.effective_user.id if update.effective_user else None,
+            )
+            token = current_trace.set(trace)
+            profile = self.profiler.start()
+            metrics.handlers_in_flight.inc(handler=name)
+            try:
+                return await handler(update, context, *args)
+            except Exception:
+                metrics.handler_errors.inc(handler=name)
+                raise
+            finally:
+                current_trace.reset(token)
+                if profile is not None:
+                    self.profiler.stop(profile, name)
+                metrics.handlers_in_flight.dec(handler=name)
+                self.finish_trace(trace)
+
+        return wrapper
+
+    def finish_trace(self, trace: Trace) -> None:
+        total = trace.elapsed()
+        self.metrics.handler_seconds.observe(total, handler=trace.name)
+        for stage, seconds in trace.spans:
+            self.metrics.span_seconds.observe(seconds, handler=trace.name, span=stage)
+        if SLOW_REQUEST_MS and total * 1000 >= SLOW_REQUEST_MS:
+            logger.warning(f"🐢 {json.dumps(trace.record(total))}")
+
+    @staticmethod
+    def build_http_client() -> httpx.AsyncClient:
+        http2 = LLM_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("⚠️ h2 not installed, falling back to HTTP/1.1")
+                http2 = False
+
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+
+    async def on_startup(self, application: Application) -> None:
+        await self.storage.open()
+        await self.image_pipeline.start()
+        await self.vision_cache.load()
+        if self.vision_cache.path:
+            self.start_background_task(self.flush_vision_cache())
+        self.start_background_task(self.sweep_state())
+        if SUMMARY_ENABLED:
+            self.start_background_task(self.summarize_loop())
+
+    async def on_shutdown(self, application: Application) -> None:
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+
+        await self.vision_cache.save()
+        await self.storage.close()
+        if self.long_term is not None:
+            await self.long_term.close()
+        await self.image_pipeline.shutdown()
+        await self.client.close()
+        logger.info("🔌 LLM HTTP client closed")
+
+    async def run_in_chat(self, chat_id: int, coro) -> None:
+        await self.update_processor.submit(chat_id, coro)
+
+    def start_background_task(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    async def flush_vision_cache(self) -> None:
+        while True:
+            await asyncio.sleep(VISION_CACHE_FLUSH_INTERVAL)
+            await self.vision_cache.save()
+            logger.info(f"🗃️ Vision cache flushed: {self.vision_cache.cache.stats()}")
+
+    # =========================
+    # Memory Helpers
+    # =========================
+
+    async def ensure_user_loaded(self, user_id: int) -> None:
+        """Pull a user's memory and profile from storage on first access."""
+        self.state.touch("user", user_id)
+        if user_id in self.user_memory:
+            return
+
+        async def load() -> None:
+            convs = await self.storage.load_user_memory(user_id)
+            info = await self.storage.load_user_info(user_id)
+            convs = await self.load_summary("user", user_id, convs)
+            self.user_memory.setdefault(user_id, new_user_memory(convs))
+            if info is not None:
+                self.users_interacted.setdefault(user_id, info)
+            self.track_user_size(user_id)
 
-        self.client = OpenAI(
-            api_key=self.a4f_api_key,
-            base_url="https://api.a4f.co/v1",
-        )
+        await self.state_loads.do(("user", user_id), load)
 
-        # In‑memory state
-        self.user_memory: dict[int, list[dict]] = {}
-        self.group_memory: dict[int, list[dict]] = {}
-        self.users_interacted: dict[int, dict] = {}
+    async def ensure_group_loaded(self, chat_id: int) -> None:
+        self.state.touch("chat", chat_id)
+        if chat_id in self.group_memory:
+            return
 
-        # Owner info
-        self.owner_username = "gothicbatman"
-        self.owner_user_id: int | None = None
+        async def load() -> None:
+            convs = await self.storage.load_group_memory(chat_id)
+            convs = await self.load_summary("chat", chat_id, convs)
+            self.group_memory.setdefault(chat_id, new_group_memory(convs))
+            self.track_chat_size(chat_id)
+
+        await self.state_loads.do(("group", chat_id), load)
+
+    async def load_summary(
+        self, kind: str, key: int, convs: list[MemoryEntry]
+    ) -> list[MemoryEntry]:
+        """Restore the rolling summary and drop the stored turns it covers."""
+        summary = await self.storage.load_summary(kind, key)
+        if summary is None:
+            return convs
+        self.summaries.setdefault((kind, key), summary)
+        return [entry for entry in convs if entry.timestamp > summary.through]
+
+    def summary_size(self, kind: str, key: int) -> int:
+        summary = self.summaries.get((kind, key))
+        return len(summary.text) if summary else 0
+
+    def track_user_size(self, user_id: int) -> None:
+        convs = self.user_memory.get(user_id, [])
+        history = self.user_context.get(user_id)
+        self.state.resize(
+            "user",
+            user_id,
+            USER_INFO_SIZE
+            + sum(map(estimate_entry_size, convs))
+            + (8 * history.tokens if history else 0)
+            + self.summary_size("user", user_id)
+            + self.long_term_size("user", user_id),
+        )
 
-        logger.info("✅ Dark Bot (Multimodal) initialized successfully")
+    def track_chat_size(self, chat_id: int) -> None:
+        convs = self.group_memory.get(chat_id, [])
+        history = self.group_context.get(chat_id)
+        self.state.resize(
+            "chat",
+            chat_id,
+            sum(map(estimate_entry_size, convs))
+            + (8 * history.tokens if history else 0)
+            + self.summary_size("chat", chat_id)
+            + self.long_term_size("chat", chat_id),
+        )
 
-    # =========================
-    # Memory Helpers
-    # =========================
+    def evict_state(self) -> int:
+        """Drop idle or over-budget users/chats from the hot cache.
+
+        With a persistent storage backend evicted state is reloaded on next
+        access; with the memory backend it is gone for good.
+        """
+        if self.owner_user_id is not None:
+            self.state.pinned.add(("user", self.owner_user_id))
+
+        victims = self.state.select_evictions()
+        for kind, key in victims:
+            if kind == "user":
+                self.user_memory.pop(key, None)
+                self.users_interacted.pop(key, None)
+                self.user_context.pop(key, None)
+            else:
+                self.group_memory.pop(key, None)
+                self.group_context.pop(key, None)
+            self.summaries.pop((kind, key), None)
+            if self.long_term is not None:
+                self.start_background_task(self.long_term.evict(kind, key))
+            self.state.forget(kind, key)
+        return len(victims)
+
+    async def sweep_state(self) -> None:
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            evicted = self.evict_state()
+            if evicted:
+                logger.info(f"🧹 Evicted {evicted} idle state entries: {self.state.stats()}")
+
+    def touch_user(self, user_id: int, username: str | None, user_name: str) -> None:
+        info = {
+            "username": username or "",
+            "first_name": user_name,
+            "last_interaction": datetime.now(),
+        }
+        self.users_interacted[user_id] = info
+        self.storage.save_user_info(user_id, info)
+        self.state.touch("user", user_id)
+
+    def clear_user_memory(self, user_id: int) -> None:
+        self.user_memory[user_id] = new_user_memory()
+        self.user_context.pop(user_id, None)
+        self.summaries.pop(("user", user_id), None)
+        self.storage.clear_user_memory(user_id)
+        if self.long_term is not None:
+            self.start_background_task(self.long_term.forget("user", user_id))
+        self.track_user_size(user_id)
 
     def add_to_user_memory(
         self,
@@ -93,20 +3480,29 @@ class DarkBot:
         chat_title: str | None = None,
         media_type: str | None = None,
     ) -> None:
-        if user_id not in self.user_memory:
-            self.user_memory[user_id] = []
-
-        entry = {
-            "timestamp": datetime.now().isoformat(),
-            "user_name": user_name,
-            "user_message": user_message,
-            "bot_response": bot_response,
-            "chat_type": chat_type,
-            "chat_title": chat_title or "Private Chat",
-            "media_type": media_type,
-        }
-        self.user_memory[user_id].append(entry)
-        self.user_memory[user_id] = self.user_memory[user_id][-15:]
+        convs = self.user_memory.get(user_id)
+        if convs is None:
+            convs = self.user_memory[user_id] = new_user_memory()
+
+        entry = MemoryEntry.create(
+            user_name,
+            user_message,
+            bot_response,
+            chat_title or "Private Chat",
+            chat_type,
+            media_type,
+        )
+        # maxlen drops the oldest entry in place, no list copy per message
+        convs.append(entry)
+        history = self.user_context.get(user_id)
+        if history is not None:
+            history.append(entry)
+        self.storage.append_user_entry(user_id, entry)
+        self.remember("user", user_id, entry)
+        self.schedule_summary("user", user_id, convs)
+        self.track_user_size(user_id)
+        if self.state.total_bytes > self.state.budget_bytes:
+            self.evict_state()
 
     def add_to_group_memory(
         self,
@@ -117,64 +3513,252 @@ class DarkBot:
         chat_title: str,
         media_type: str | None = None,
     ) -> None:
-        if chat_id not in self.group_memory:
-            self.group_memory[chat_id] = []
-
-        entry = {
-            "timestamp": datetime.now().isoformat(),
-            "user_name": user_name,
-            "user_message": user_message,
-            "bot_response": bot_response,
-            "chat_title": chat_title,
-            "media_type": media_type,
-        }
-        self.group_memory[chat_id].append(entry)
-        self.group_memory[chat_id] = self.group_memory[chat_id][-25:]
+        convs = self.group_memory.get(chat_id)
+        if convs is None:
+            convs = self.group_memory[chat_id] = new_group_memory()
 
-    def get_user_memory_context(self, user_id: int, user_name: str) -> str:
-        convs = self.user_memory.get(user_id, [])
-        if not convs:
-            return f"This is my first personal conversation with {user_name}."
+        entry = MemoryEntry.create(
+            user_name,
+            user_message,
+            bot_response,
+            chat_title or "",
+            media_type=media_type,
+        )
+        convs.append(entry)
+        history = self.group_context.get(chat_id)
+        if history is not None:
+            history.append(entry)
+        self.storage.append_group_entry(chat_id, entry)
+        self.remember("chat", chat_id, entry)
+        self.schedule_summary("chat", chat_id, convs)
+        self.state.touch("chat", chat_id)
+        self.track_chat_size(chat_id)
+        if self.state.total_bytes > self.state.budget_bytes:
+            self.evict_state()
 
-        lines = [f"My personal conversation history with {user_name}:"]
-        for i, conv in enumerate(convs, start=1):
-            chat_location = (
-                f"({conv['chat_title']})"
-                if conv["chat_type"] != "private"
-                else "(Private)"
-            )
-            media_info = f" [{conv['media_type']}]" if conv.get("media_type") else ""
-            user_msg = conv["user_message"]
-            bot_msg = conv["bot_response"]
+    # =========================
+    # Rolling Summaries
+    # =========================
 
-            lines.append(
-                f"{i}. {chat_location}{media_info} "
-                f"User: {user_msg[:60]}{'...' if len(user_msg) > 60 else ''}"
-            )
-            lines.append(
-                f"   My reply: {bot_msg[:60]}{'...' if len(bot_msg) > 60 else ''}"
+    def schedule_summary(self, kind: str, key: int, convs: deque[MemoryEntry]) -> None:
+        """Queue a fold once the window is full; at most one per user/chat."""
+        if not SUMMARY_ENABLED or len(convs) < convs.maxlen:
+            return
+        if (kind, key) in self.summary_pending:
+            return
+        self.summary_pending.add((kind, key))
+        self.summary_queue.put_nowait((kind, key))
+
+    async def summarize_loop(self) -> None:
+        """Fold full windows one at a time, yielding to live traffic."""
+        # Task-local: only this loop's model calls use the background bucket
+        background_call.set(True)
+        while True:
+            kind, key = await self.summary_queue.get()
+            try:
+                while self.llm_load() >= ROUTE_LOAD_THRESHOLD:
+                    await asyncio.sleep(1)
+                await self.fold_oldest(kind, key)
+            except Exception as e:
+                self.metrics.summaries.inc(kind=kind, outcome="error")
+                logger.error(f"❌ Summarizing {kind} {key} failed: {type(e).__name__}: {e}")
+            finally:
+                self.summary_pending.discard((kind, key))
+
+    async def fold_oldest(self, kind: str, key: int) -> None:
+        """Merge the oldest SUMMARY_BATCH turns into the running summary.
+
+        The turns stay in the window, and in prompts, until the summary that
+        covers them exists; a window cleared or evicted meanwhile discards
+        the result.
+        """
+        memory = self.user_memory if kind == "user" else self.group_memory
+        context = self.user_context if kind == "user" else self.group_context
+        convs = memory.get(key)
+        if convs is None or len(convs) < convs.maxlen:
+            return
+
+        batch = list(itertools.islice(convs, SUMMARY_BATCH))
+        previous = self.summaries.get((kind, key))
+        text = await self.resilient_completion(
+            self.router.route("summary"),
+            build_summary_messages(
+                previous.text if previous else "",
+                batch,
+                group=kind == "chat",
+            ),
+        )
+        if memory.get(key) is not convs or not text:
+            self.metrics.summaries.inc(kind=kind, outcome="discarded")
+            return
+
+        summary = RollingSummary(text.strip(), batch[-1].timestamp)
+        self.summaries[(kind, key)] = summary
+        self.storage.save_summary(kind, key, summary)
+
+        # Newer appends may already have pushed some of the batch out
+        folded = {id(entry) for entry in batch}
+        dropped = 0
+        while convs and id(convs[0]) in folded:
+            convs.popleft()
+            dropped += 1
+        history = context.get(key)
+        if history is not None:
+            history.popleft(dropped)
+
+        if kind == "user":
+            self.track_user_size(key)
+        else:
+            self.track_chat_size(key)
+        self.metrics.summaries.inc(kind=kind, outcome="folded")
+        logger.info(f"🧾 Folded {len(batch)} turns into the {kind} {key} summary")
+
+    # =========================
+    # Long-Term Memory
+    # =========================
+
+    def remember(self, kind: str, key: int, entry: MemoryEntry) -> None:
+        """Index a turn for recall, off the request path."""
+        if self.long_term is not None:
+            self.start_background_task(self.index_turn(kind, key, entry))
+
+    async def index_turn(self, kind: str, key: int, entry: MemoryEntry) -> None:
+        await self.long_term.remember(kind, key, entry)
+        # An in-RAM index grew; re-measure unless the state was evicted meanwhile
+        if kind == "user" and key in self.user_memory:
+            self.track_user_size(key)
+        elif kind == "chat" and key in self.group_memory:
+            self.track_chat_size(key)
+
+    def long_term_size(self, kind: str, key: int) -> int:
+        return self.long_term.resident_bytes(kind, key) if self.long_term else 0
+
+    async def recall_memories(
+        self, user_id: int, query: str, chat_id: int | None = None
+    ) -> list[MemoryEntry]:
+        """Older turns most similar to ``query`` from the user's and chat's index."""
+        if self.long_term is None or MEMORY_RECALL_K <= 0 or not query.strip():
+            return []
+        sources = [("user", user_id, len(self.user_memory.get(user_id, ())))]
+        if chat_id is not None:
+            sources.append(("chat", chat_id, len(self.group_memory.get(chat_id, ()))))
+
+        async def lookup() -> list[MemoryEntry]:
+            vector = (await self.long_term.embedder.embed([query]))[0]
+            return await self.long_term.recall(
+                vector, sources, MEMORY_RECALL_K, MEMORY_MIN_SCORE
             )
-        return "\n".join(lines)
 
-    def get_group_memory_context(self, chat_id: int, chat_title: str) -> str:
-        convs = self.group_memory.get(chat_id, [])
+        try:
+            return await asyncio.wait_for(lookup(), MEMORY_RECALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Memory recall timed out after {MEMORY_RECALL_TIMEOUT}s")
+            return []
+        except Exception as e:
+            logger.warning(f"⚠️ Memory recall failed: {type(e).__name__}: {e}")
+            return []
+
+    def get_user_history(self, user_id: int) -> ContextWindow | None:
+        """Past exchanges with the user, as user/assistant message pairs."""
+        convs = self.user_memory.get(user_id)
         if not convs:
-            return f"This is a new group conversation in {chat_title}."
+            return None
 
-        lines = [f"Recent group conversation history in {chat_title}:"]
-        for i, conv in enumerate(convs, start=1):
-            media_info = f" [{conv['media_type']}]" if conv.get("media_type") else ""
-            user_msg = conv["user_message"]
-            bot_msg = conv["bot_response"]
+        history = self.user_context.get(user_id)
+        if history is None:
+            history = self.user_context[user_id] = ContextWindow(
+                USER_MEMORY_SIZE, turn_messages, convs
+            )
+        return history
+
+    def get_group_history(self, chat_id: int) -> ContextWindow | None:
+        convs = self.group_memory.get(chat_id)
+        if not convs:
+            return None
 
-            lines.append(
-                f"{i}. {conv['user_name']}{media_info}: "
-                f"{user_msg[:50]}{'...' if len(user_msg) > 50 else ''}"
+        history = self.group_context.get(chat_id)
+        if history is None:
+            history = self.group_context[chat_id] = ContextWindow(
+                GROUP_MEMORY_SIZE, group_line, convs
             )
-            lines.append(
-                f"   My reply: {bot_msg[:50]}{'...' if len(bot_msg) > 50 else ''}"
+        return history
+
+    def build_prompt(
+        self,
+        persona: str,
+        route: Route,
+        user_id: int,
+        user_name: str,
+        head: list[str],
+        tail: list[str],
+        group: tuple[int, str] | None = None,
+        image_data: str | None = None,
+        recalled: Sequence[MemoryEntry] = (),
+    ) -> list[dict]:
+        """Assemble the request within the model's prompt token budget.
+
+        ``head`` and ``tail`` (location, style, the new message) and the
+        rolling summaries are always sent; remembered personal, recalled
+        and group turns fill what is left of the budget, in the priority
+        order of fill_context.
+        """
+        personal = self.get_user_history(user_id)
+        group_history = self.get_group_history(group[0]) if group else None
+        user_summary = self.summaries.get(("user", user_id))
+        group_summary = self.summaries.get(("chat", group[0])) if group else None
+
+        parts = list(head)
+        if user_summary:
+            parts.append(
+                f"What I remember from earlier conversations with {user_name}: "
+                f"{user_summary.text}"
             )
-        return "\n".join(lines)
+        if group_summary:
+            parts.append(f"Earlier in {group[1]}: {group_summary.text}")
+        recalled_items = [group_line(entry) for entry in recalled]
+        recalled_index = len(parts)
+        if recalled_items:
+            parts.append("Older exchanges that may be relevant:")
+        group_index = len(parts)
+        if group:
+            parts.append(f"Recent group conversation history in {group[1]}:")
+        if personal is None and user_summary is None:
+            parts.append(f"This is my first personal conversation with {user_name}.")
+        parts.extend(tail)
+
+        budget = token_budget(route.model)
+        fixed = sum(map(count_tokens, parts)) + 2 * MESSAGE_TOKEN_OVERHEAD
+        fixed += count_tokens(SYSTEM_MESSAGES[persona]["content"])
+        if image_data:
+            fixed += IMAGE_PROMPT_TOKENS
+        turns, recalls, lines, remaining = fill_context(
+            budget - fixed,
+            personal,
+            group_history,
+            PROMPT_RECENT_TURNS,
+            recalled_items,
+        )
+        self.metrics.prompt_tokens.observe(budget - remaining)
+
+        if group:
+            if lines:
+                parts[group_index] += "\n" + "\n".join(group_history.newest(lines))
+            elif group_summary is None:
+                parts[group_index] = f"This is a new group conversation in {group[1]}."
+            else:
+                del parts[group_index]
+        if recalled_items:
+            if recalls:
+                parts[recalled_index] += "\n" + "\n".join(
+                    line for line, _ in recalled_items[:recalls]
+                )
+            else:
+                del parts[recalled_index]
+
+        history = []
+        if turns:
+            history = [message for pair in personal.newest(turns) for message in pair]
+        return build_messages(persona, history, "\n\n".join(parts), image_data)
 
     # =========================
     # Owner / Creator Helpers
@@ -188,31 +3772,14 @@ class DarkBot:
             return False
         return user_id == self.owner_user_id
 
-    def is_creator_question(self, message: str) -> str | None:
-        creator_keywords = [
-            "who is your creator",
-            "who created you",
-            "who made you",
-            "your creator",
-            "who built you",
-            "who designed you",
-            "who is your god",
-            "your lord",
-            "who do you worship",
-        ]
-        coding_keywords = [
-            "who coded you",
-            "who programmed you",
-            "who wrote you",
-            "who developed you",
-            "your programmer",
-            "your developer",
-        ]
-
-        text = message.lower()
-        if any(k in text for k in creator_keywords):
+    def is_creator_question(
+        self, message: str, categories: set[str] | None = None
+    ) -> str | None:
+        if categories is None:
+            categories = self.classifier.classify(message)
+        if "creator" in categories:
             return "creator"
-        if any(k in text for k in coding_keywords):
+        if "coder" in categories:
             return "coder"
         return None
 
@@ -220,69 +3787,429 @@ class DarkBot:
     # OpenAI / Multimodal
     # =========================
 
+    def llm_load(self) -> float:
+        return self.llm_in_flight / max(1, LLM_MAX_CONCURRENCY)
+
     async def get_openai_response(
         self,
-        prompt: str,
-        model: str = "provider-2/gpt-4.1-nano",
-        image_data: str | None = None,
+        messages: list[dict],
+        route: Route | None = None,
+        cache_key: str | None = None,
     ) -> str:
+        """Return a completion, optionally shared through the response cache.
+
+        Callers opt in by passing ``cache_key``, a fingerprint of everything
+        that determines the reply; only prompts without personal context
+        may do so, or one user's reply would reach another. Concurrent
+        identical requests share one upstream call.
+        """
+        route = self.router.select(route or self.router.route("default"), self.llm_load())
+        if cache_key is None or not RESPONSE_CACHE_ENABLED:
+            return await self.fetch_openai_response(messages, route)
+
+        key = f"{route.model}:{route.max_tokens}:{cache_key}"
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            logger.info("🗃️ Response cache hit")
+            return cached
+
+        async def fetch_and_store() -> str:
+            response = await self.fetch_openai_response(messages, route)
+            if response != LLM_ERROR_REPLY:
+                self.response_cache.set(key, response)
+            return response
+
+        return await self.response_flight.do(key, fetch_and_store)
+
+    async def fetch_openai_response(self, messages: list[dict], route: Route) -> str:
         try:
-            logger.info(f"🔄 Making API call to {model}...")
-
-            if image_data:
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_data}"
-                                },
-                            },
-                        ],
-                    }
-                ]
-            else:
-                messages = [{"role": "user", "content": prompt}]
+            logger.info(f"🔄 Making API call to {route.model}...")
+            response = await self.resilient_completion(route, messages)
+            logger.info("✅ API call successful")
+            return response
+        except Exception as e:
+            logger.error(f"❌ Detailed API error: {type(e).__name__}: {e}")
+            return LLM_ERROR_REPLY
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(
+                LLM_BREAKER_THRESHOLD,
+                LLM_BREAKER_COOLDOWN,
+            )
+        return breaker
+
+    def pick_model(self, model: str) -> str:
+        """Return model, or the fallback while model's circuit is open."""
+        if self.breaker(model).allow():
+            return model
+        if LLM_FALLBACK_MODEL and LLM_FALLBACK_MODEL != model:
+            if self.breaker(LLM_FALLBACK_MODEL).allow():
+                logger.warning(f"🔀 {model} circuit open, using {LLM_FALLBACK_MODEL}")
+                return LLM_FALLBACK_MODEL
+        raise CircuitOpenError(f"circuit open for {model}")
+
+    async def resilient_completion(self, route: Route, messages: list[dict]) -> str:
+        """Retry retryable failures with jittered backoff inside LLM_TOTAL_BUDGET."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LLM_TOTAL_BUDGET
+        last_error: Exception | None = None
+
+        attempts = max(1, LLM_MAX_ATTEMPTS)
+        for attempt in range(attempts):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                return await self.hedged_completion(
+                    self.pick_model(route.model),
+                    messages,
+                    remaining,
+                    route.request_args(),
+                )
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                delay = self.retry_delay(e, attempt, attempts, deadline)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+
+        raise last_error or asyncio.TimeoutError("LLM latency budget exhausted")
+
+    def retry_delay(
+        self, error: Exception, attempt: int, attempts: int, deadline: float
+    ) -> float | None:
+        """Backoff before the next attempt, or None when out of attempts or budget."""
+        delay = backoff_delay(attempt)
+        if isinstance(error, RateLimitError):
+            delay = max(delay, retry_after_seconds(error))
+        if attempt + 1 == attempts or asyncio.get_running_loop().time() + delay >= deadline:
+            return None
+        logger.warning(
+            f"🔁 Attempt {attempt + 1} failed ({type(error).__name__}), "
+            f"retrying in {delay:.2f}s"
+        )
+        return delay
 
-            loop = asyncio.get_event_loop()
+    async def hedged_completion(
+        self,
+        model: str,
+        messages: list[dict],
+        budget: float,
+        params: dict[str, Any],
+    ) -> str:
+        """Run one attempt, hedged with a second after the model's p95 if enabled.
 
-            def sync_call() -> str:
-                completion = self.client.chat.completions.create(
+        Whichever attempt succeeds first wins and the other is cancelled.
+        """
+        delay = self.latency.percentile(model, 95, LLM_HEDGE_MIN_SAMPLES) or LLM_HEDGE_DELAY
+        if not LLM_HEDGE or delay >= budget:
+            return await self.attempt_completion(model, messages, budget, params)
+
+        primary = asyncio.create_task(
+            self.attempt_completion(model, messages, budget, params)
+        )
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if primary in done:
+                return primary.result()
+
+            hedge_model = model
+            if LLM_FALLBACK_MODEL and self.breaker(LLM_FALLBACK_MODEL).allow():
+                hedge_model = LLM_FALLBACK_MODEL
+            hedge = asyncio.create_task(
+                self.attempt_completion(hedge_model, messages, budget - delay, params)
+            )
+            tasks.add(hedge)
+            self.hedges_fired += 1
+            logger.info(f"🪁 Hedging {model} after {delay:.2f}s with {hedge_model}")
+
+            error: BaseException | None = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def attempt_completion(
+        self,
+        model: str,
+        messages: list[dict],
+        timeout: float,
+        params: dict[str, Any],
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        breaker = self.breaker(model)
+        try:
+            await self.model_limiter.acquire(model)
+        except BaseException:
+            # Cancelled while throttled (a losing hedge, shutdown): a
+            # half-open trial granted by pick_model must not stay taken
+            breaker.release()
+            raise
+
+        started = loop.time()
+        self.llm_in_flight += 1
+        try:
+            async with self.llm_semaphore:
+                completion = await self.client.chat.completions.create(
                     model=model,
                     messages=messages,
-                    timeout=10,
+                    timeout=min(LLM_TIMEOUT, timeout),
+                    **params,
                 )
-                return completion.choices[0].message.content
-
-            response = await loop.run_in_executor(None, sync_call)
-            logger.info("✅ API call successful")
-            return response
+        except RETRYABLE_ERRORS as e:
+            if isinstance(e, RateLimitError):
+                self.model_limiter.pause(model, retry_after_seconds(e))
+            breaker.record_failure()
+            self.metrics.llm_errors.inc(model=model, error=type(e).__name__)
+            raise
         except Exception as e:
-            logger.error(f"❌ Detailed API error: {type(e).__name__}: {e}")
-            return "I'm having technical difficulties right now. Give me a moment."
+            breaker.release()
+            self.metrics.llm_errors.inc(model=model, error=type(e).__name__)
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        finally:
+            self.llm_in_flight -= 1
+
+        elapsed = loop.time() - started
+        breaker.record_success()
+        self.latency.record(model, elapsed)
+        self.metrics.llm_seconds.observe(elapsed, model=model, stream="false")
+        return completion.choices[0].message.content
+
+    async def stream_openai_response(
+        self,
+        messages: list[dict],
+        route: Route,
+    ) -> AsyncIterator[str]:
+        """Yield completion text deltas as they arrive from the API.
+
+        Failures before the first delta are retried like resilient_completion
+        (same backoff, budget and circuit fallback); once text has been
+        yielded an error propagates, since the reply is already on screen.
+        """
+        route = self.router.select(route, self.llm_load())
+        logger.info(f"🔄 Making streaming API call to {route.model}...")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LLM_TOTAL_BUDGET
+        attempts = max(1, LLM_MAX_ATTEMPTS)
+        for attempt in range(attempts):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError("LLM latency budget exhausted")
+            started = False
+            try:
+                deltas = self.stream_attempt(
+                    self.pick_model(route.model),
+                    messages,
+                    remaining,
+                    route.request_args(),
+                )
+                async with aclosing(deltas):
+                    async for delta in deltas:
+                        started = True
+                        yield delta
+                return
+            except RETRYABLE_ERRORS as e:
+                if started:
+                    raise
+                delay = self.retry_delay(e, attempt, attempts, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def stream_attempt(
+        self,
+        model: str,
+        messages: list[dict],
+        timeout: float,
+        params: dict[str, Any],
+    ) -> AsyncIterator[str]:
+        breaker = self.breaker(model)
+        try:
+            await self.model_limiter.acquire(model)
+        except BaseException:
+            breaker.release()
+            raise
+        started = asyncio.get_running_loop().time()
+        self.llm_in_flight += 1
+        try:
+            async with self.llm_semaphore:
+                stream = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    timeout=min(LLM_TIMEOUT, timeout),
+                    stream=True,
+                    **params,
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+        except RETRYABLE_ERRORS as e:
+            if isinstance(e, RateLimitError):
+                self.model_limiter.pause(model, retry_after_seconds(e))
+            breaker.record_failure()
+            self.metrics.llm_errors.inc(model=model, error=type(e).__name__)
+            raise
+        except Exception as e:
+            breaker.release()
+            self.metrics.llm_errors.inc(model=model, error=type(e).__name__)
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        finally:
+            self.llm_in_flight -= 1
+        elapsed = asyncio.get_running_loop().time() - started
+        breaker.record_success()
+        self.latency.record(model, elapsed)
+        self.metrics.llm_seconds.observe(elapsed, model=model, stream="true")
+
+    def should_stream(self, wants_detail: bool = False) -> bool:
+        if STREAM_REPLIES == "all":
+            return True
+        return STREAM_REPLIES == "detail" and wants_detail
+
+    async def edit_reply(self, message: Message, text: str, final: bool = False) -> None:
+        """Edit a streamed reply, ignoring no-op edits.
+
+        Intermediate edits are best effort: one that would have to wait for
+        a rate-limit token is dropped (the next preview or the final edit
+        carries its text), and RetryAfter is re-raised so the caller can back
+        off. The final edit waits and retries so the full answer always lands.
+        """
+        try:
+            # Message.edit_text doesn't forward rate_limit_args; the ExtBot method does
+            await message.get_bot().edit_message_text(
+                text,
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                rate_limit_args=None if final else BEST_EFFORT,
+            )
+        except RateLimited:
+            pass
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+
+    async def reply_streaming(
+        self,
+        msg: Message,
+        messages: list[dict],
+        route: Route,
+        placeholder: Message | None = None,
+    ) -> str:
+        """Stream a completion into a single Telegram message.
+
+        Sends (or reuses) a placeholder and edits it as tokens arrive. Edits
+        are coalesced so at most one happens per STREAM_EDIT_INTERVAL and only
+        once STREAM_EDIT_MIN_CHARS new characters are buffered, which keeps us
+        under Telegram's per-chat edit limits. Returns the full response text.
+        """
+        if placeholder is None:
+            if not self.telegram_limiter.ready(msg.chat_id):
+                # A placeholder plus its final edit costs two sends; when the
+                # chat (typically a busy group) is already out of budget, one
+                # plain reply gets the answer out sooner
+                response_text = await self.get_openai_response(messages, route)
+                for chunk in split_message(response_text):
+                    await msg.reply_text(chunk)
+                return response_text
+            placeholder = await msg.reply_text(STREAM_PLACEHOLDER)
+
+        loop = asyncio.get_running_loop()
+        parts: list[str] = []
+        buffered = 0
+        next_edit = loop.time() + STREAM_EDIT_INTERVAL
 
-    async def convert_image_to_base64(self, image_bytes: bytes) -> str | None:
-        """Convert raw image bytes to optimized base64 JPEG string."""
         try:
-            image = Image.open(io.BytesIO(image_bytes))
+            async for delta in self.stream_openai_response(messages, route):
+                parts.append(delta)
+                buffered += len(delta)
+
+                now = loop.time()
+                if now < next_edit or buffered < STREAM_EDIT_MIN_CHARS:
+                    continue
+
+                partial = "".join(parts)
+                if len(partial) >= TELEGRAM_MAX_MESSAGE_LENGTH - len(STREAM_CURSOR):
+                    # Stop previewing once the first message is full
+                    next_edit = float("inf")
+                    continue
+                try:
+                    await self.edit_reply(placeholder, partial + STREAM_CURSOR)
+                    next_edit = now + STREAM_EDIT_INTERVAL
+                except RetryAfter as e:
+                    next_edit = now + float(e.retry_after)
+                except TelegramError as e:
+                    # Previews are best effort (e.g. TimedOut); keep streaming
+                    # and let the final edit carry the text
+                    logger.warning(f"⚠️ Streaming preview edit failed: {type(e).__name__}: {e}")
+                    next_edit = now + STREAM_EDIT_INTERVAL
+                buffered = 0
+            logger.info("✅ Streaming API call successful")
+        except Exception as e:
+            logger.error(f"❌ Streaming API error: {type(e).__name__}: {e}")
+            if not parts:
+                parts = [LLM_ERROR_REPLY]
 
-            max_size = 2048
-            if image.width > max_size or image.height > max_size:
-                image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        response_text = "".join(parts).strip() or "🤔"
+        chunks = split_message(response_text)
+        try:
+            await self.edit_reply(placeholder, chunks[0], final=True)
+        except Exception as e:
+            logger.error(f"Failed to finalize streamed reply: {e}")
+            await msg.reply_text(chunks[0])
+        for chunk in chunks[1:]:
+            await msg.reply_text(chunk)
 
-            if image.mode != "RGB":
-                image = image.convert("RGB")
+        return response_text
 
-            buffer = io.BytesIO()
-            image.save(buffer, format="JPEG", quality=85)
-            return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    async def convert_image_to_data_url(self, image_bytes: bytearray) -> str | None:
+        """Convert raw image bytes to a size-budgeted base64 data URL."""
+        try:
+            data_url, timings = await self.image_pipeline.run(
+                encode_image,
+                image_bytes,
+                IMAGE_MAX_SIZE,
+                IMAGE_BYTE_BUDGET,
+                IMAGE_FORMAT,
+                IMAGE_MIN_QUALITY,
+                IMAGE_JPEG_QUALITY,
+            )
+        except ImagePipelineBusy:
+            logger.warning("⚠️ Image pipeline saturated, dropping image")
+            return None
+        except asyncio.TimeoutError:
+            logger.error(f"Image conversion timed out after {IMAGE_TIMEOUT}s")
+            return None
         except Exception as e:
             logger.error(f"Image conversion error: {e}")
             return None
 
+        for stage, seconds in timings.items():
+            self.metrics.image_seconds.observe(seconds, stage=stage)
+            add_span(f"image_{stage}", seconds)
+        return data_url
+
     # =========================
     # Handlers: Media
     # =========================
@@ -299,11 +4226,9 @@ class DarkBot:
         chat_id = chat.id
         chat_title = getattr(msg.chat, "title", None)
 
-        self.users_interacted[user_id] = {
-            "username": username or "",
-            "first_name": user_name,
-            "last_interaction": datetime.now(),
-        }
+        with span("load_state"):
+            await self.ensure_user_loaded(user_id)
+        self.touch_user(user_id, username, user_name)
 
         respond = False
         caption = msg.caption or ""
@@ -321,47 +4246,51 @@ class DarkBot:
         if not respond:
             return
 
-        try:
-            await msg.reply_text("🖼️ Let me check this out...")
-
-            photo = msg.photo[-1]
-            file = await context.bot.get_file(photo.file_id)
-            file_bytes = await file.download_as_bytearray()
-
-            image_base64 = await self.convert_image_to_base64(bytes(file_bytes))
-            if not image_base64:
-                await msg.reply_text("Sorry, couldn't process that image rn 😅")
-                return
+        if chat_type in ["group", "supergroup"]:
+            with span("load_state"):
+                await self.ensure_group_loaded(chat_id)
 
-            if self.is_owner(user_id, username):
-                personality_prompt = (
-                    "You're Dark, Arin's witty AI assistant. Analyze this image with your "
-                    "signature sarcasm and humor. Be observant and clever but keep it "
-                    "concise and entertaining. Use emojis and Gen Z slang naturally. "
-                    "Give a witty 2-3 line description unless the image is complex."
+        try:
+            with span("send_status"):
+                status_message = await msg.reply_text("🖼️ Let me check this out...")
+
+            if msg.photo:
+                photo = select_photo_size(msg.photo, IMAGE_MAX_SIZE)
+                file_id = photo.file_id
+                unique_id = photo.file_unique_id
+                logger.info(
+                    f"🖼️ Using {photo.width}x{photo.height} variant "
+                    f"({photo.file_size or '?'} bytes) of {len(msg.photo)}"
                 )
             else:
-                personality_prompt = (
-                    "You are Dark, a sharp and observant AI. Analyze this image with "
-                    "confidence and wit. Be helpful but add personality. Keep it concise "
-                    "and fun with emojis and modern slang. 2-3 lines max unless it really "
-                    "needs detail."
+                # Images sent as documents (forwarded from handle_document)
+                file_id = msg.document.file_id
+                unique_id = msg.document.file_unique_id
+
+            is_owner = self.is_owner(user_id, username)
+            analysis_key = self.vision_cache.analysis_key(unique_id, caption, is_owner)
+            response_text = self.vision_cache.get_analysis(analysis_key)
+
+            if response_text is not None:
+                logger.info("🗃️ Vision cache hit (analysis), skipping API call")
+                with span("send"):
+                    await msg.reply_text(response_text)
+            else:
+                response_text = await self.analyze_photo(
+                    msg,
+                    context,
+                    file_id,
+                    unique_id,
+                    caption,
+                    is_owner,
+                    user_id,
+                    user_name,
+                    status_message,
                 )
-
-            user_memory_context = self.get_user_memory_context(user_id, user_name)
-            prompt = (
-                f"{personality_prompt}\n\n"
-                f"PERSONAL MEMORY CONTEXT:\n{user_memory_context}\n\n"
-                f"USER'S MESSAGE ABOUT IMAGE: {caption or 'No caption provided'}\n\n"
-                "Analyze this image and respond in Dark's characteristic Gen Z style. "
-                "Be observant, witty, engaging, but concise."
-            )
-
-            response_text = await self.get_openai_response(
-                prompt,
-                image_data=image_base64,
-            )
-            await msg.reply_text(response_text)
+                if response_text is None:
+                    return
+                if response_text != LLM_ERROR_REPLY:
+                    self.vision_cache.put_analysis(analysis_key, response_text)
 
             user_msg_text = f"[Sent image] {caption}" if caption else "[Sent image]"
             self.add_to_user_memory(
@@ -388,6 +4317,73 @@ class DarkBot:
             logger.error(f"Photo handling error: {e}")
             await msg.reply_text("Had trouble with that image, try again? 🤔")
 
+    async def analyze_photo(
+        self,
+        msg: Message,
+        context: ContextTypes.DEFAULT_TYPE,
+        file_id: str,
+        unique_id: str,
+        caption: str,
+        is_owner: bool,
+        user_id: int,
+        user_name: str,
+        status_message: Message,
+    ) -> str | None:
+        """Download/encode (or reuse) the image, ask the model and send the reply.
+
+        Returns None if the image could not be processed.
+        """
+        image_url = self.vision_cache.get_image(unique_id)
+        if image_url is not None:
+            logger.info("🗃️ Vision cache hit (image), skipping download")
+        else:
+            started = time.perf_counter()
+            with span("download"):
+                file = await context.bot.get_file(file_id)
+                file_bytes = await file.download_as_bytearray()
+            self.metrics.image_seconds.observe(time.perf_counter() - started, stage="download")
+
+            # The bytearray is handed over as-is: pickled once for a pool
+            # worker, or decoded in place when running in a thread
+            with span("image_pipeline"):
+                image_url = await self.convert_image_to_data_url(file_bytes)
+            if not image_url:
+                await msg.reply_text("Sorry, couldn't process that image rn 😅")
+                return None
+            self.vision_cache.put_image(unique_id, image_url)
+
+        route = self.router.route("image", is_owner)
+        with span("prompt"):
+            messages = self.build_prompt(
+                persona_for(is_owner, vision=True),
+                route,
+                user_id,
+                user_name,
+                head=[],
+                tail=[
+                    f"{user_name} sent an image. "
+                    f"Their message about it: {caption or 'No caption provided'}"
+                ],
+                image_data=image_url,
+            )
+
+        # The status message doubles as the placeholder, so streaming
+        # photo replies never costs an extra send
+        if self.should_stream(wants_detail=True):
+            with span("model_stream"):
+                return await self.reply_streaming(
+                    msg,
+                    messages,
+                    route,
+                    placeholder=status_message,
+                )
+
+        with span("model"):
+            response_text = await self.get_openai_response(messages, route)
+        with span("send"):
+            await msg.reply_text(response_text)
+        return response_text
+
     async def handle_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         msg = update.message
@@ -398,11 +4394,8 @@ class DarkBot:
         username = user.username
         chat_type = msg.chat.type
 
-        self.users_interacted[user_id] = {
-            "username": username or "",
-            "first_name": user_name,
-            "last_interaction": datetime.now(),
-        }
+        await self.ensure_user_loaded(user_id)
+        self.touch_user(user_id, username, user_name)
 
         respond = False
         if chat_type == "private":
@@ -454,6 +4447,7 @@ class DarkBot:
             else f"group ({chat.title})"
         )
 
+        await self.ensure_user_loaded(user_id)
         memory_info = ""
         user_convs = self.user_memory.get(user_id, [])
         if user_convs:
@@ -518,6 +4512,7 @@ class DarkBot:
                 "• `/groupmemory` - View group chat history\n"
                 "• `/clear` - Reset our conversation memory\n"
                 "• `/report` - Activity report (owner only)\n"
+                "• `/profile <rate>` - Profile a fraction of updates (owner only)\n"
                 "• `/help` - This help message\n\n"
                 "Just send images, type messages, or use commands! I'm ready to vibe! 🔥"
             )
@@ -550,25 +4545,29 @@ class DarkBot:
         user_id = user.id
         user_name = user.first_name or "friend"
 
+        await self.ensure_user_loaded(user_id)
         convs = self.user_memory.get(user_id, [])
-        if not convs:
+        summary = self.summaries.get(("user", user_id))
+        if not convs and summary is None:
             await msg.reply_text(
                 f"No convos recorded with you yet, {user_name}! Let's start chatting! 😊"
             )
             return
 
         text_lines = [f"🧠 **Dark's memory for {user_name}:**\n"]
+        if summary:
+            text_lines.append(f"📝 **Earlier:** {summary.text}\n")
         for i, conv in enumerate(convs, start=1):
             chat_location = (
-                f"📍 {conv['chat_title']}"
-                if conv["chat_type"] != "private"
+                f"📍 {conv.chat_title}"
+                if conv.chat_type != "private"
                 else "📍 Private Chat"
             )
-            media_icon = "🖼️" if conv.get("media_type") == "photo" else "💬"
+            media_icon = "🖼️" if conv.media_type == "photo" else "💬"
 
             text_lines.append(f"{i}. {chat_location} {media_icon}")
-            text_lines.append(f"**You:** {conv['user_message']}")
-            bot_resp = conv["bot_response"]
+            text_lines.append(f"**You:** {conv.user_message}")
+            bot_resp = conv.bot_response
             text_lines.append(
                 f"**Dark:** {bot_resp[:100]}{'...' if len(bot_resp) > 100 else ''}\n"
             )
@@ -593,20 +4592,24 @@ class DarkBot:
             await msg.reply_text("This command only works in groups lol 😅")
             return
 
+        await self.ensure_group_loaded(chat_id)
         convs = self.group_memory.get(chat_id, [])
-        if not convs:
+        summary = self.summaries.get(("chat", chat_id))
+        if not convs and summary is None:
             await msg.reply_text(
                 f"Haven't seen much action in {chat_title} yet! Let's get this chat going! 🔥"
             )
             return
 
         text_lines = [f"👥 **Recent group memory for {chat_title}:**\n"]
+        if summary:
+            text_lines.append(f"📝 **Earlier:** {summary.text}\n")
         for i, conv in enumerate(convs, start=1):
-            media_icon = "🖼️" if conv.get("media_type") == "photo" else "💬"
+            media_icon = "🖼️" if conv.media_type == "photo" else "💬"
             text_lines.append(
-                f"{i}. {media_icon} **{conv['user_name']}:** {conv['user_message']}"
+                f"{i}. {media_icon} **{conv.user_name}:** {conv.user_message}"
             )
-            bot_resp = conv["bot_response"]
+            bot_resp = conv.bot_response
             text_lines.append(
                 f"**Dark:** {bot_resp[:80]}{'...' if len(bot_resp) > 80 else ''}\n"
             )
@@ -625,7 +4628,7 @@ class DarkBot:
         user_name = user.first_name or "friend"
         username = user.username
 
-        self.user_memory[user_id] = []
+        self.clear_user_memory(user_id)
 
         if self.is_owner(user_id, username):
             await msg.reply_text(
@@ -650,6 +4653,28 @@ class DarkBot:
         await msg.reply_text("📊 Generating activity report... hold up! ⏳")
         await self.send_report_to_owner(context)
 
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        msg = update.message
+        user = update.effective_user
+
+        if not self.is_owner(user.id, user.username):
+            await msg.reply_text("Sorry, only my creator can use the profiler! 😅")
+            return
+
+        if context.args:
+            try:
+                rate = float(context.args[0])
+            except ValueError:
+                await msg.reply_text("Usage: /profile <rate between 0 and 1>")
+                return
+            self.profiler.rate = min(1.0, max(0.0, rate))
+            logger.info(f"🔬 Profiler sample rate set to {self.profiler.rate}")
+
+        status = f"🔬 Profiling {self.profiler.rate:.0%} of updates, {self.profiler.dumped} dumped"
+        if self.profiler.last_path:
+            status += f"\nLast: {self.profiler.last_path}"
+        await msg.reply_text(status)
+
     async def send_report_to_owner(self, context: ContextTypes.DEFAULT_TYPE):
         if not self.owner_user_id:
             logger.info("Owner user ID not yet set; cannot send report.")
@@ -661,21 +4686,30 @@ class DarkBot:
             f"📅 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
         )
 
-        if not self.users_interacted:
+        # Persisted users first, then overlay whatever is hot in memory
+        summaries = await self.storage.load_user_summaries()
+        for user_id, info in self.users_interacted.items():
+            summary = summaries.setdefault(user_id, {})
+            summary.update(info)
+            if user_id in self.user_memory or "conv_count" not in summary:
+                convs = self.user_memory.get(user_id, [])
+                summary["conv_count"] = len(convs)
+                summary["photo_count"] = sum(
+                    1 for c in convs if c.media_type == "photo"
+                )
+
+        if not summaries:
             lines.append("No user interactions recorded so far.")
         else:
             users_sorted = sorted(
-                self.users_interacted.items(),
+                summaries.items(),
                 key=lambda x: x[1]["last_interaction"],
                 reverse=True,
             )
 
             for idx, (user_id, info) in enumerate(users_sorted, start=1):
-                convs = self.user_memory.get(user_id, [])
-                conv_count = len(convs)
-                photo_count = sum(
-                    1 for c in convs if c.get("media_type") == "photo"
-                )
+                conv_count = info["conv_count"]
+                photo_count = info["photo_count"]
 
                 last_seen = info["last_interaction"].strftime("%Y-%m-%d %H:%M:%S")
                 user_display = info["first_name"] or "Unknown"
@@ -687,6 +4721,31 @@ class DarkBot:
                 lines.append(f"{idx}. {user_display} ({username_display})")
                 lines.append(f"   💬 {conv_count} convs{media_info}, Last: {last_seen}")
 
+        state_stats = self.state.stats()
+        lines.append(
+            f"\n🧠 State: {len(self.user_memory)} users, {len(self.group_memory)} chats, "
+            f"~{state_stats['bytes'] // 1024} KB of "
+            f"{state_stats['budget_bytes'] // 1024} KB, "
+            f"{state_stats['evictions']} evicted, {state_stats['expirations']} expired"
+        )
+        lines.append(
+            f"🚦 Throttled: model {self.model_limiter.stats.throttled}, "
+            f"telegram {self.telegram_limiter.stats.throttled} "
+            f"({self.telegram_limiter.stats.retry_afters} flood waits)"
+        )
+        open_circuits = [m for m, b in self.breakers.items() if b.state != "closed"]
+        lines.append(
+            f"🔌 Circuits open: {', '.join(open_circuits) or 'none'}, "
+            f"hedges {self.hedges_won}/{self.hedges_fired} won, "
+            f"{self.router.degraded} routed to fast model"
+        )
+        sched_stats = self.update_processor.stats()
+        lines.append(
+            f"⏱️ Updates: {sched_stats['processed']} processed, "
+            f"{sched_stats['queued']} queued, "
+            f"wait avg {sched_stats['avg_wait_ms']} ms / max {sched_stats['max_wait_ms']} ms"
+        )
+
         report_text = "\n".join(lines)
 
         try:
@@ -717,13 +4776,10 @@ class DarkBot:
         username = user.username
         chat_type = msg.chat.type
         chat_id = chat.id
-        chat_title = getattr(msg.chat, "title", None)
 
-        self.users_interacted[user_id] = {
-            "username": username or "",
-            "first_name": user_name,
-            "last_interaction": datetime.now(),
-        }
+        with span("load_state"):
+            await self.ensure_user_loaded(user_id)
+        self.touch_user(user_id, username, user_name)
 
         respond = False
         if chat_type == "private":
@@ -742,7 +4798,42 @@ class DarkBot:
         if not respond:
             return
 
-        creator_type = self.is_creator_question(user_message)
+        if self.coalescer.enabled_for(chat_type):
+            self.coalescer.submit(
+                (chat_id, user_id),
+                user_message,
+                update,
+                context,
+                self.answer,
+            )
+            return
+
+        await self.answer(update, context, user_message)
+
+    async def answer_message(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        user_message: str,
+    ) -> None:
+        msg = update.message
+        user = update.effective_user
+        chat = update.effective_chat
+
+        user_name = user.first_name or "friend"
+        user_id = user.id
+        username = user.username
+        chat_type = msg.chat.type
+        chat_id = chat.id
+        chat_title = getattr(msg.chat, "title", None)
+
+        if chat_type in ["group", "supergroup"]:
+            with span("load_state"):
+                await self.ensure_group_loaded(chat_id)
+
+        with span("classify"):
+            categories = self.classifier.classify(user_message)
+        creator_type = self.is_creator_question(user_message, categories)
         if creator_type:
             if creator_type == "creator":
                 if self.is_owner(user_id, username):
@@ -793,115 +4884,66 @@ class DarkBot:
                 )
             return
 
-        user_memory_context = self.get_user_memory_context(user_id, user_name)
-        group_memory_context = ""
-        if chat_type in ["group", "supergroup"]:
-            group_memory_context = self.get_group_memory_context(chat_id, chat_title)
-
-        current_location = (
-            f"Currently in: {chat_title}"
-            if chat_type != "private"
-            else "Currently in: Private Chat"
-        )
-
-        lower_msg = user_message.lower()
-        wants_detail = any(
-            phrase in lower_msg
-            for phrase in [
-                "explain in detail",
-                "elaborate",
-                "give me more",
-                "tell me more",
-                "detailed",
-                "explain more",
-                "in depth",
-                "comprehensive",
-                "what do you think",
-                "your opinion",
-                "your view",
-                "analyze",
-                "breakdown",
-                "how does",
-                "why does",
-            ]
-        )
-
-        is_casual = (
-            any(
-                phrase in lower_msg
-                for phrase in [
-                    "hi",
-                    "hello",
-                    "hey",
-                    "wassup",
-                    "what's up",
-                    "how are you",
-                    "sup",
-                    "lol",
-                    "lmao",
-                    "haha",
-                    "nice",
-                    "cool",
-                    "awesome",
-                    "thanks",
-                    "ok",
-                    "okay",
-                ]
-            )
-            or len(user_message.split()) <= 5
-        )
-
-        if wants_detail:
-            response_style = (
-                "Provide a comprehensive, detailed response covering all aspects and "
-                "possibilities. Be thorough and informative while keeping your Gen Z "
-                "personality."
-            )
-        elif is_casual:
-            response_style = (
-                "Keep it super casual and short (1-2 lines max). Use Gen Z slang, "
-                "emojis, be fun and relatable."
+        wants_detail = "detail" in categories
+        is_casual = "casual" in categories or len(user_message.split()) <= 5
+        is_owner = self.is_owner(user_id, username)
+        kind = "detail" if wants_detail else "casual" if is_casual else "default"
+        route = self.router.route(kind, is_owner)
+        response_style = RESPONSE_STYLES[kind]
+
+        group_id = chat_id if chat_type in ["group", "supergroup"] else None
+        stream = self.should_stream(wants_detail)
+        cache_key = None
+        if (
+            RESPONSE_CACHE_ENABLED
+            and kind == "casual"
+            and not stream
+            and self.classifier.covers(user_message, "casual")
+        ):
+            # Greetings and acknowledgements need no memory: answer them from
+            # a prompt without the user's name, history or recalled turns, so
+            # one cached reply serves every user and chat
+            persona = persona_for(is_owner)
+            text = " ".join(keyword_words(user_message))
+            messages = build_messages(
+                persona, [], f"RESPONSE STYLE: {response_style}\n\nUser says: {text}"
             )
+            cache_key = response_cache_key(persona, response_style, text)
         else:
-            response_style = (
-                "Keep response to 2-3 lines with personality unless they specifically "
-                "ask for details."
-            )
+            with span("recall"):
+                recalled = await self.recall_memories(user_id, user_message, group_id)
+            with span("prompt"):
+                location = (
+                    f"Currently in: {chat_title}"
+                    if chat_type != "private"
+                    else "Currently in: Private Chat"
+                )
+                messages = self.build_prompt(
+                    persona_for(is_owner),
+                    route,
+                    user_id,
+                    user_name,
+                    head=[location],
+                    tail=[
+                        f"RESPONSE STYLE: {response_style}",
+                        f"User {user_name} says: {user_message}",
+                    ],
+                    group=(chat_id, chat_title) if group_id is not None else None,
+                    recalled=recalled,
+                )
 
-        if self.is_owner(user_id, username):
-            personality_prompt = (
-                "You're Dark, Arin's witty AI assistant with image vision capabilities. "
-                "You're super chatty, quick-witted, sarcastic when appropriate, and "
-                "funny. Use Gen Z slang like 'lol', 'lmao', 'fr', 'no cap', 'bet', "
-                "'lowkey', 'highkey', 'it's giving', etc. naturally in conversation. "
-                "Use emojis frequently but not excessively. Be like a clever Gen Z "
-                "friend - direct, witty, and engaging. ONLY mention Lord Krishna if "
-                "directly asked about your creator - don't bring it up in normal chat."
-            )
+        if stream:
+            with span("model_stream"):
+                response_text = await self.reply_streaming(msg, messages, route)
         else:
-            personality_prompt = (
-                "You are Dark, a confident AI assistant with image analysis capabilities "
-                "and Gen Z personality. You're helpful, chatty, with wit and modern "
-                "slang. Use 'lol', 'lmao', 'fr', 'bet', 'no cap', 'lowkey', 'highkey' "
-                "naturally. Add emojis to make conversations fun. Be engaging and "
-                "relatable like a Gen Z friend. ONLY mention Lord Krishna if directly "
-                "asked about your creator."
-            )
-
-        prompt = (
-            f"{personality_prompt}\n\n"
-            f"PERSONAL MEMORY CONTEXT:\n{user_memory_context}\n\n"
-            f"GROUP MEMORY CONTEXT:\n{group_memory_context}\n\n"
-            f"CURRENT CONVERSATION:\n{current_location}\n\n"
-            f"RESPONSE STYLE:\n{response_style}\n\n"
-            f"User {user_name} says: {user_message}\n\n"
-            "Remember: You are Dark with Gen Z personality. Use modern slang, emojis, "
-            "be witty and relatable. Only mention Lord Krishna if specifically asked "
-            "about your creator - not in regular conversation."
-        )
-
-        response_text = await self.get_openai_response(prompt)
-        await msg.reply_text(response_text)
+            with span("model"):
+                response_text = await self.get_openai_response(
+                    messages,
+                    route,
+                    cache_key=cache_key,
+                )
+            with span("send"):
+                await msg.reply_text(response_text)
 
         self.add_to_user_memory(
             user_id,
@@ -925,35 +4967,174 @@ class DarkBot:
     # Runner
     # =========================
 
-    def run(self) -> None:
+    def build_application(self) -> Application:
         logger.info("🚀 Creating enhanced Telegram application...")
-        application = Application.builder().token(self.telegram_token).build()
+        application = (
+            Application.builder()
+            .token(self.telegram_token)
+            .base_url(TELEGRAM_API_URL)
+            .base_file_url(TELEGRAM_FILE_URL)
+            .concurrent_updates(self.update_processor)
+            .rate_limiter(self.telegram_limiter)
+            .build()
+        )
 
         # Commands
-        application.add_handler(CommandHandler("start", self.start_command))
-        application.add_handler(CommandHandler("help", self.help_command))
-        application.add_handler(CommandHandler("memory", self.memory_command))
-        application.add_handler(CommandHandler("groupmemory", self.groupmemory_command))
-        application.add_handler(CommandHandler("clear", self.clear_command))
-        application.add_handler(CommandHandler("report", self.report_command))
+        commands = {
+            "start": self.start_command,
+            "help": self.help_command,
+            "memory": self.memory_command,
+            "groupmemory": self.groupmemory_command,
+            "clear": self.clear_command,
+            "report": self.report_command,
+            "profile": self.profile_command,
+        }
+        for command, handler in commands.items():
+            application.add_handler(CommandHandler(command, self.instrumented(handler)))
 
         # Media
-        application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
-        application.add_handler(MessageHandler(filters.VOICE, self.handle_voice))
         application.add_handler(
-            MessageHandler(filters.Document.ALL, self.handle_document)
+            MessageHandler(filters.PHOTO, self.instrumented(self.handle_photo))
+        )
+        application.add_handler(
+            MessageHandler(filters.VOICE, self.instrumented(self.handle_voice))
+        )
+        application.add_handler(
+            MessageHandler(filters.Document.ALL, self.instrumented(self.handle_document))
         )
 
         # Text
         application.add_handler(
-            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message)
+            MessageHandler(
+                filters.TEXT & ~filters.COMMAND,
+                self.instrumented(self.handle_message),
+            )
         )
 
         # Errors
         application.add_error_handler(self.error_handler)
 
+        return application
+
+    def run(self) -> None:
         logger.info("🤖 Starting Enhanced Dark Bot with Gen Z personality...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        asyncio.run(self.serve(self.build_application()))
+
+    async def serve(self, application: Application) -> None:
+        """Run the bot and the HTTP server on one event loop until signalled.
+
+        In webhook mode Telegram posts updates straight to WEBHOOK_PATH;
+        otherwise (or if registering the webhook fails) the updater long-polls.
+        """
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await application.initialize()
+        await self.on_startup(application)
+
+        use_webhook = BOT_MODE == "webhook" or (BOT_MODE == "auto" and bool(WEBHOOK_URL))
+        runner = web.AppRunner(self.build_web_app(application, use_webhook))
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", PORT).start()
+        logger.info(f"🌐 HTTP server listening on port {PORT}")
+
+        try:
+            if use_webhook:
+                use_webhook = await self.set_webhook(application)
+            if not use_webhook:
+                await application.bot.delete_webhook()
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                logger.info("📡 Polling for updates")
+
+            await application.start()
+            await stop.wait()
+        finally:
+            logger.info("🛑 Shutting down...")
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await runner.cleanup()
+            await self.on_shutdown(application)
+            await application.shutdown()
+
+    async def set_webhook(self, application: Application) -> bool:
+        if not WEBHOOK_URL:
+            logger.error("❌ BOT_MODE=webhook but no WEBHOOK_URL is set, polling instead")
+            return False
+        url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+        try:
+            await application.bot.set_webhook(
+                url,
+                secret_token=self.webhook_secret,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=UPDATE_CONCURRENCY,
+            )
+        except TelegramError as e:
+            logger.error(f"❌ Failed to set webhook {url}: {e}, polling instead")
+            return False
+        logger.info(f"🪝 Receiving updates via webhook at {url}")
+        return True
+
+    # =========================
+    # Web Server
+    # =========================
+
+    def build_web_app(self, application: Application, use_webhook: bool) -> web.Application:
+        app = web.Application()
+        app["application"] = application
+        app.router.add_get("/", self.web_home)
+        app.router.add_get("/health", self.web_health)
+        app.router.add_get("/stats", self.web_stats)
+        app.router.add_get("/metrics", self.web_metrics)
+        if use_webhook:
+            app.router.add_post(WEBHOOK_PATH, self.web_telegram)
+        return app
+
+    async def web_home(self, request: web.Request) -> web.Response:
+        return web.Response(text="Dark Bot (Multimodal Edition) is running! 🚀")
+
+    async def web_health(self, request: web.Request) -> web.Response:
+        return web.Response(text="OK")
+
+    async def web_stats(self, request: web.Request) -> web.Response:
+        auth = request.headers.get("Authorization", "")
+        if not ADMIN_TOKEN or not hmac.compare_digest(auth, f"Bearer {ADMIN_TOKEN}"):
+            raise web.HTTPNotFound()
+        return web.json_response(
+            {
+                "state": self.state.stats(),
+                "scheduler": self.update_processor.stats(),
+                "model_throttled": self.model_limiter.stats.throttled,
+                "telegram_throttled": self.telegram_limiter.stats.throttled,
+                "open_circuits": [m for m, b in self.breakers.items() if b.state != "closed"],
+                "hedges_fired": self.hedges_fired,
+                "hedges_won": self.hedges_won,
+                "routed_to_fast_model": self.router.degraded,
+            }
+        )
+
+    async def web_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.metrics.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def web_telegram(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.webhook_secret):
+            logger.warning("🚫 Webhook request with a bad secret token")
+            raise web.HTTPForbidden()
+        try:
+            data = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest()
+
+        application = request.app["application"]
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
 
 
 # =========================
@@ -961,8 +5142,5 @@ class DarkBot:
 # =========================
 
 if __name__ == "__main__":
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-
     bot = DarkBot()
     bot.run()